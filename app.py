@@ -2,14 +2,36 @@ import os
 import json
 import uuid
 import base64
+import random
+import re
+import difflib
+import hashlib
+import threading
+import sqlite3
+import time
+import io
+import shutil
+import tempfile
+import numpy as np
 import google.generativeai as genai
-from flask import Flask, request, render_template, jsonify, url_for, flash, redirect, session, abort
+from flask import Flask, request, render_template, jsonify, url_for, flash, redirect, session, abort, Response, stream_with_context, g
 from flask_login import LoginManager, UserMixin, login_user, logout_user, current_user, login_required
 from dotenv import load_dotenv
 import datetime
 from flask_wtf.csrf import CSRFProtect
+from flask.sessions import SessionInterface, SessionMixin
+from flask.json.tag import TaggedJSONSerializer
+from itsdangerous import Signer, BadSignature
+from werkzeug.datastructures import CallbackDict, FileStorage
 from functools import wraps
+from concurrent.futures import ThreadPoolExecutor
+from collections import Counter
 import requests
+from cachetools import LRUCache, TTLCache
+from PIL import Image, ImageOps
+from urllib.parse import unquote
+import click
+from google.api_core.exceptions import AlreadyExists, NotFound, PreconditionFailed
 
 # --- Firebase Admin SDK Initialization ---
 import firebase_admin
@@ -23,6 +45,81 @@ app.config['UPLOAD_FOLDER'] = 'static/uploads'
 app.config['MAX_CONTENT_LENGTH'] = 16 * 1024 * 1024 
 ALLOWED_EXTENSIONS = {'png', 'jpg', 'jpeg', 'gif', 'mp3', 'wav', 'ogg'}
 
+# --- Server-side Sessions ---
+# The cookie carries only a signed session id; the session itself lives server-side, so session
+# data never rides along on every request. A local SQLite file is not shared between serverless
+# instances, so on Vercel (or with SESSION_BACKEND=cookie) Flask's signed-cookie sessions are kept.
+SESSION_BACKEND = os.getenv("SESSION_BACKEND", "cookie" if os.getenv("VERCEL") else "sqlite")
+SESSION_TTL_SECONDS = int(os.getenv("SESSION_TTL_SECONDS", 7 * 24 * 3600))
+SESSION_DB_PATH = os.getenv("SESSION_DB_PATH", os.path.join(app.instance_path, 'sessions.sqlite3'))
+
+class ServerSession(CallbackDict, SessionMixin):
+    def __init__(self, initial=None, sid=None, new=False, refresh=False):
+        def on_update(self):
+            self.modified = True
+        super().__init__(initial, on_update)
+        self.sid, self.new, self.modified = sid, new, False
+        self.refresh = refresh  # unchanged, but past half its TTL: extend the expiry
+        self.opened_user_id = self.get('_user_id')  # a change (login, logout) rotates the sid
+
+class SqliteSessionInterface(SessionInterface):
+    """Stores sessions as rows in a local SQLite file with a sliding TTL."""
+    serializer = TaggedJSONSerializer()
+
+    def __init__(self, path, ttl_seconds):
+        self.path, self.ttl = path, ttl_seconds
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        with self._connect() as conn:
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("CREATE TABLE IF NOT EXISTS sessions (sid TEXT PRIMARY KEY, data TEXT NOT NULL, expires REAL NOT NULL)")
+
+    def _connect(self):
+        return sqlite3.connect(self.path, timeout=10)
+
+    def _signer(self, app):
+        return Signer(app.secret_key, salt='server-session')
+
+    def open_session(self, app, request):
+        cookie = request.cookies.get(self.get_cookie_name(app))
+        if cookie:
+            try:
+                sid = self._signer(app).unsign(cookie).decode()
+            except BadSignature:
+                sid = None
+            if sid:
+                with self._connect() as conn:
+                    row = conn.execute("SELECT data, expires FROM sessions WHERE sid = ?", (sid,)).fetchone()
+                if row and row[1] > time.time():
+                    return ServerSession(self.serializer.loads(row[0]), sid=sid, refresh=row[1] - time.time() < self.ttl / 2)
+        return ServerSession(sid=uuid.uuid4().hex, new=True)
+
+    def save_session(self, app, session, response):
+        name, domain, path = self.get_cookie_name(app), self.get_cookie_domain(app), self.get_cookie_path(app)
+        if not session:
+            if session.modified and not session.new:
+                with self._connect() as conn:
+                    conn.execute("DELETE FROM sessions WHERE sid = ?", (session.sid,))
+                response.delete_cookie(name, domain=domain, path=path)
+            return
+        if not (session.modified or session.refresh):
+            return
+        expires = time.time() + self.ttl
+        with self._connect() as conn:
+            if not session.new and session.get('_user_id') != session.opened_user_id:
+                # A sid planted before login must not become the authenticated session (session fixation).
+                conn.execute("DELETE FROM sessions WHERE sid = ?", (session.sid,))
+                session.sid = uuid.uuid4().hex
+            conn.execute("INSERT OR REPLACE INTO sessions (sid, data, expires) VALUES (?, ?, ?)",
+                         (session.sid, self.serializer.dumps(dict(session)), expires))
+            if random.random() < 0.01:
+                conn.execute("DELETE FROM sessions WHERE expires < ?", (time.time(),))
+        response.set_cookie(name, self._signer(app).sign(session.sid).decode(),
+                            expires=self.get_expiration_time(app, session), httponly=self.get_cookie_httponly(app),
+                            domain=domain, path=path, secure=self.get_cookie_secure(app), samesite=self.get_cookie_samesite(app))
+
+if SESSION_BACKEND == 'sqlite':
+    app.session_interface = SqliteSessionInterface(SESSION_DB_PATH, SESSION_TTL_SECONDS)
+
 csrf = CSRFProtect(app)
 login_manager = LoginManager(app)
 login_manager.login_view = 'login'
@@ -58,9 +155,332 @@ if os.getenv("GEMINI_API_KEY"):
     genai.configure(api_key=os.getenv("GEMINI_API_KEY"))
 os.makedirs(app.config['UPLOAD_FOLDER'], exist_ok=True)
 
-RAG_RETRIEVERS = {}
+# Lesson embeddings live in two tiers: a size-capped in-process LRU in front of the
+# `lesson_embeddings` collection, where each record is keyed by lesson id and tagged with
+# a hash of the script it was built from, so an edited lesson never serves stale vectors.
+RAG_EMBEDDING_MODEL = 'models/text-embedding-004'
+RAG_CACHE_MAX_BYTES = int(os.getenv("RAG_CACHE_MAX_BYTES", 64 * 1024 * 1024))
+RAG_PERSIST_MAX_BYTES = 900 * 1024  # stay under Firestore's 1 MiB document limit
+RAG_TOP_K = 3
+EMBED_BATCH_SIZE = 100  # batchEmbedContents accepts at most 100 texts per call
+
+# Work that can finish after the response is sent (e.g. indexing a freshly saved chapter).
+BACKGROUND_EXECUTOR = ThreadPoolExecutor(max_workers=int(os.getenv("BACKGROUND_WORKERS", 2)), thread_name_prefix='background')
+
+def _rag_cache_entry_size(entry):
+    _, rag_index = entry
+    return rag_index['matrix'].nbytes + sum(len(chunk) for chunk in rag_index['chunks']) or 1
+
+RAG_RETRIEVERS = LRUCache(maxsize=RAG_CACHE_MAX_BYTES, getsizeof=_rag_cache_entry_size)
+RAG_RETRIEVERS_LOCK = threading.Lock()
+
+# --- Data Access ---
+# get_many splits large id lists into get_all calls of this size and runs them side by side.
+BATCH_GET_CHUNK_SIZE = 100
+BATCH_GET_EXECUTOR = ThreadPoolExecutor(max_workers=int(os.getenv("BATCH_GET_WORKERS", 8)), thread_name_prefix='batch-get')
+
+# Enrollments and chat histories have deterministic ids so lookups are direct gets. Documents created
+# before that have random ids; until `flask migrate-document-ids` has run, a miss falls back to the
+# old indexed query. Set LEGACY_ID_FALLBACK=0 once the migration is done.
+LEGACY_ID_FALLBACK = os.getenv("LEGACY_ID_FALLBACK", "1") == "1"
+
+def enrollment_id_for(uid, course_id):
+    return f"{uid}_{course_id}"
+
+def chat_history_id_for(enrollment_id, lesson_id):
+    return f"{enrollment_id}_{lesson_id}"
+
+class FirestoreRepository:
+    """Request-scoped Firestore access.
+
+    Keeps an identity map so each document is read at most once per request, memoizes the
+    shared lookups routes repeat, and counts the reads and writes the request made.
+    """
+    def __init__(self, client):
+        self.client = client
+        self.reads = 0
+        self.writes = 0
+        self._documents = {}
+        self._queries = {}
+
+    def collection(self, name):
+        return self.client.collection(name)
+
+    def ref(self, collection, doc_id):
+        return self.client.collection(collection).document(doc_id)
+
+    def new_id(self, collection):
+        return self.client.collection(collection).document().id
+
+    def get(self, collection, doc_id):
+        path = f"{collection}/{doc_id}"
+        if path not in self._documents:
+            self.reads += 1
+            self._documents[path] = _doc_to_dict(self.ref(collection, doc_id).get())
+        return self._documents[path]
+
+    def get_many(self, collection, doc_ids):
+        """Returns {doc_id: dict} for the documents that exist, loading the unseen ones in concurrent batches."""
+        doc_ids = list(dict.fromkeys(i for i in doc_ids if i))
+        missing = [i for i in doc_ids if f"{collection}/{i}" not in self._documents]
+        if missing:
+            chunks = [missing[i:i + BATCH_GET_CHUNK_SIZE] for i in range(0, len(missing), BATCH_GET_CHUNK_SIZE)]
+            fetch = lambda chunk: list(self.client.get_all([self.ref(collection, i) for i in chunk]))
+            pages = BATCH_GET_EXECUTOR.map(fetch, chunks) if len(chunks) > 1 else [fetch(chunks[0])]
+            # Results are merged on the calling thread; the identity map and counters are not thread-safe.
+            for page in pages:
+                for snapshot in page:
+                    self._documents[snapshot.reference.path] = _doc_to_dict(snapshot)
+            self.reads += len(missing)
+        return {i: self._documents[f"{collection}/{i}"] for i in doc_ids if self._documents.get(f"{collection}/{i}")}
+
+    def get_all(self, *keys):
+        """Loads (collection, doc_id) pairs from any collections in one round trip; returns dicts (None if missing) in order."""
+        paths = [f"{collection}/{doc_id}" for collection, doc_id in keys]
+        missing = list(dict.fromkeys(p for p in paths if p not in self._documents))
+        if missing:
+            for snapshot in self.client.get_all([self.client.document(p) for p in missing]):
+                self._documents[snapshot.reference.path] = _doc_to_dict(snapshot)
+            self.reads += len(missing)
+        return [self._documents.get(p) for p in paths]
+
+    def stream(self, query, memo_key=None, remember=True):
+        """Runs a query once per request (per memo_key). Projected queries must pass remember=False."""
+        if memo_key is not None and memo_key in self._queries: return self._queries[memo_key]
+        results = []
+        for snapshot in query.stream():
+            doc = _doc_to_dict(snapshot)
+            if remember: self._documents[snapshot.reference.path] = doc
+            results.append(doc)
+        self.reads += max(len(results), 1)
+        if memo_key is not None: self._queries[memo_key] = results
+        return results
+
+    def first(self, query, memo_key=None):
+        results = self.stream(query.limit(1), memo_key)
+        return results[0] if results else None
+
+    def find_enrollment(self, user_id, course_id):
+        enrollment = self.get('enrollments', enrollment_id_for(user_id, course_id))
+        if enrollment or not LEGACY_ID_FALLBACK: return enrollment
+        query = self.collection('enrollments').where('user_id', '==', user_id).where('course_id', '==', course_id)
+        return self.first(query, memo_key=('enrollment', user_id, course_id))
+
+    def find_chat_history(self, enrollment_id, lesson_id):
+        history = self.get('chat_histories', chat_history_id_for(enrollment_id, lesson_id))
+        if history or not LEGACY_ID_FALLBACK: return history
+        query = self.collection('chat_histories').where('enrollment_id', '==', enrollment_id).where('lesson_id', '==', lesson_id)
+        return self.first(query, memo_key=('chat_history', enrollment_id, lesson_id))
+
+    def course_lessons(self, course_id):
+        query = self.collection('lessons').where('course_id', '==', course_id).order_by('chapter_number')
+        return self.stream(query, memo_key=('course_lessons', course_id))
+
+    def add(self, collection, data):
+        _, doc_ref = self.collection(collection).add(data)
+        self._wrote(f"{collection}/{doc_ref.id}")
+        return doc_ref.id
+
+    def set(self, collection, doc_id, data, merge=False):
+        self.ref(collection, doc_id).set(data, merge=merge)
+        self._wrote(f"{collection}/{doc_id}")
+
+    def create(self, collection, doc_id, data):
+        """Writes a new document, raising AlreadyExists if the id is taken."""
+        self.ref(collection, doc_id).create(data)
+        self._wrote(f"{collection}/{doc_id}")
+
+    def update(self, collection, doc_id, data):
+        self.ref(collection, doc_id).update(data)
+        self._wrote(f"{collection}/{doc_id}")
+
+    def delete(self, collection, doc_id):
+        self.ref(collection, doc_id).delete()
+        self._wrote(f"{collection}/{doc_id}")
+
+    def batch(self):
+        return RepositoryBatch(self)
+
+    def record_transaction(self, reads=0, writes=0, paths=()):
+        """Accounts for work done through a transaction or batch outside this class."""
+        self.reads += reads
+        for path in paths: self._wrote(path, count=False)
+        self.writes += writes
+
+    def _wrote(self, path, count=True):
+        # Server-side transforms (Increment, SERVER_TIMESTAMP) can't be replayed locally, so forget the cached copy.
+        if count: self.writes += 1
+        self._documents.pop(path, None)
+        self._queries.clear()
+        if path.startswith('users/'): invalidate_user_cache(path.split('/', 1)[1])
+
+class RepositoryBatch:
+    """A WriteBatch addressed by collection and id, committed in one round trip and counted on the repository."""
+    def __init__(self, repository):
+        self.repository = repository
+        self.batch = repository.client.batch()
+        self.paths = []
+
+    def _stage(self, collection, doc_id):
+        doc_ref = self.repository.ref(collection, doc_id)
+        self.paths.append(doc_ref.path)
+        return doc_ref
+
+    def set(self, collection, doc_id, data, merge=False):
+        self.batch.set(self._stage(collection, doc_id), data, merge=merge)
+
+    def create(self, collection, doc_id, data):
+        self.batch.create(self._stage(collection, doc_id), data)
+
+    def update(self, collection, doc_id, data):
+        self.batch.update(self._stage(collection, doc_id), data)
+
+    def commit(self):
+        if not self.paths: return
+        self.batch.commit()
+        self.repository.record_transaction(writes=len(self.paths), paths=self.paths)
+
+def repo():
+    """The FirestoreRepository for the current request."""
+    if 'repo' not in g:
+        g.repo = FirestoreRepository(db)
+    return g.repo
+
+@app.after_request
+def add_firestore_usage_headers(response):
+    repository = g.get('repo')
+    if repository is not None:
+        response.headers['X-Firestore-Reads'] = str(repository.reads)
+        response.headers['X-Firestore-Writes'] = str(repository.writes)
+    return response
+
+@app.teardown_request
+def record_firestore_usage(exc):
+    # Runs after a streamed body finishes, so writes made while streaming are included.
+    repository = g.pop('repo', None)
+    if repository is not None:
+        record_metric('firestore_requests')
+        record_metric('firestore_reads', repository.reads)
+        record_metric('firestore_writes', repository.writes)
+
+# --- Course Table of Contents ---
+# Each course document carries a compact `toc` (id, title, chapter_number, step_count) so chapter
+# navigation never has to stream full lesson documents with their scripts and parsed JSON.
+TOC_BACKFILL_FIELDS = ['title', 'chapter_number', 'parsed_json']
+
+def toc_entry(lesson_id, title, chapter_number, parsed_data):
+    return {'id': lesson_id, 'title': title, 'chapter_number': chapter_number, 'step_count': len(parsed_data.get('steps', []))}
+
+def get_course_toc(course):
+    """Returns the course's toc, building and saving it once for courses created before it existed."""
+    if 'toc' not in course:
+        query = repo().collection('lessons').where('course_id', '==', course['id']).order_by('chapter_number').select(TOC_BACKFILL_FIELDS)
+        lessons = repo().stream(query, remember=False)
+        course['toc'] = [toc_entry(l['id'], l.get('title'), l.get('chapter_number'), json.loads(l.get('parsed_json') or '{}')) for l in lessons]
+        repo().update('courses', course['id'], {'toc': course['toc']})
+    return course['toc']
+
+def chapter_is_live(item):
+    """Whether students see a chapter (a lesson or its toc entry). A new chapter is a draft at version 0
+    until its first ingestion saves it; entries written before drafts existed carry no version."""
+    return item.get('version', 1) > 0
+
+def live_toc(course):
+    """The toc students see: every chapter except drafts still being ingested or that failed to ingest."""
+    return [entry for entry in get_course_toc(course) if chapter_is_live(entry)]
+
+def toc_lookup(toc, chapter_number):
+    return next((entry for entry in toc if entry.get('chapter_number') == chapter_number), None)
+
+def save_toc_entry(course_id, entry):
+    """Inserts or replaces one chapter's toc entry, inside a transaction so concurrent edits don't drop each other."""
+    course_ref = repo().ref('courses', course_id)
+
+    @firestore.transactional
+    def write_toc(transaction):
+        snapshot = course_ref.get(transaction=transaction)
+        toc = [e for e in (snapshot.to_dict() or {}).get('toc', []) if e['id'] != entry['id']]
+        toc.append(entry)
+        toc.sort(key=lambda e: e.get('chapter_number') or 0)
+        transaction.update(course_ref, {'toc': toc, 'lesson_count': sum(1 for e in toc if chapter_is_live(e))})
+
+    write_toc(repo().client.transaction())
+    repo().record_transaction(reads=1, writes=1, paths=[course_ref.path])
+
+# --- Course Catalog ---
+# /explore pages through published courses newest-first. The first page is a precomputed snapshot
+# stored in catalog/explore (and held in memory briefly), rebuilt whenever a course enters, leaves
+# or changes in the catalog, so the homepage costs at most one read however large the library is.
+EXPLORE_PAGE_SIZE = 24
+CATALOG_CACHE = TTLCache(maxsize=1, ttl=int(os.getenv("CATALOG_CACHE_TTL_SECONDS", 60)))
+CATALOG_CACHE_LOCK = threading.Lock()
+# Refreshes get their own worker so they never wait behind slow BACKGROUND_EXECUTOR jobs (prewarming, indexing).
+CATALOG_EXECUTOR = ThreadPoolExecutor(max_workers=1, thread_name_prefix='catalog')
+
+def _catalog_query(client):
+    return client.collection('courses').where('status', '==', 'published') \
+        .order_by('created_at', direction=firestore.Query.DESCENDING).order_by('__name__', direction=firestore.Query.DESCENDING)
+
+def catalog_card(course, creator):
+    """The few fields an explore card shows; this is what the snapshot stores per course."""
+    return {
+        'id': course['id'], 'title': course.get('title'), 'thumbnail_url': course.get('thumbnail_url'),
+        'thumbnail_variants': course.get('thumbnail_variants', []),
+        'lesson_count': course.get('lesson_count', 0), 'review_count': course.get('review_count', 0),
+        'average_rating': course.get('average_rating', 0.0), 'creator': {'username': (creator or {}).get('username')}
+    }
+
+def _catalog_page(courses, creators):
+    """Turns up to EXPLORE_PAGE_SIZE + 1 courses into a page of cards and the cursor for the next one."""
+    cards = [catalog_card(c, creators.get(c.get('user_id'))) for c in courses[:EXPLORE_PAGE_SIZE]]
+    return {'courses': cards, 'next_cursor': cards[-1]['id'] if len(courses) > EXPLORE_PAGE_SIZE else None}
+
+def refresh_catalog_snapshot():
+    """Rebuilds the first explore page. Runs in the background, outside any request."""
+    try:
+        courses = [_doc_to_dict(s) for s in _catalog_query(db).limit(EXPLORE_PAGE_SIZE + 1).stream()]
+        creator_refs = [db.collection('users').document(uid) for uid in {c.get('user_id') for c in courses} if uid]
+        creators = {s.id: s.to_dict() for s in db.get_all(creator_refs) if s.exists} if creator_refs else {}
+        snapshot = _catalog_page(courses, creators)
+        db.collection('catalog').document('explore').set({**snapshot, 'updated_at': firestore.SERVER_TIMESTAMP})
+        with CATALOG_CACHE_LOCK:
+            CATALOG_CACHE['explore'] = snapshot
+        return snapshot
+    except Exception as e:
+        print(f"Error refreshing the explore catalog snapshot: {e}")
+        return None
+
+def catalog_changed():
+    CATALOG_EXECUTOR.submit(refresh_catalog_snapshot)
+
+def get_catalog_snapshot():
+    with CATALOG_CACHE_LOCK:
+        snapshot = CATALOG_CACHE.get('explore')
+    if snapshot: return snapshot
+    stored = repo().get('catalog', 'explore')
+    if not stored: return refresh_catalog_snapshot() or {'courses': [], 'next_cursor': None}
+    snapshot = {'courses': stored.get('courses', []), 'next_cursor': stored.get('next_cursor')}
+    with CATALOG_CACHE_LOCK:
+        CATALOG_CACHE['explore'] = snapshot
+    return snapshot
 
 # --- User and Auth Management ---
+# load_user runs on every authenticated request, so user records and positive enrollment checks are
+# cached per process for a short TTL. Writes made here invalidate explicitly; the TTL bounds how long
+# another instance (or a console edit) can go unnoticed.
+AUTH_CACHE_TTL_SECONDS = int(os.getenv("AUTH_CACHE_TTL_SECONDS", 300))
+USER_CACHE = TTLCache(maxsize=10000, ttl=AUTH_CACHE_TTL_SECONDS)
+ENROLLMENT_CACHE = TTLCache(maxsize=50000, ttl=AUTH_CACHE_TTL_SECONDS)
+AUTH_CACHE_LOCK = threading.Lock()
+
+def invalidate_user_cache(uid):
+    with AUTH_CACHE_LOCK:
+        USER_CACHE.pop(uid, None)
+
+def remember_enrollment(uid, course_id):
+    with AUTH_CACHE_LOCK:
+        ENROLLMENT_CACHE[(uid, course_id)] = True
+
 class User(UserMixin):
     def __init__(self, uid, user_data):
         self.id = uid
@@ -70,16 +490,31 @@ class User(UserMixin):
 
     def is_enrolled(self, course):
         if not db or not course or not course.get('id'): return False
-        enrollment_ref = db.collection('enrollments').where('user_id', '==', self.uid).where('course_id', '==', course['id']).limit(1).stream()
-        return len(list(enrollment_ref)) > 0
+        with AUTH_CACHE_LOCK:
+            cached = ENROLLMENT_CACHE.get((self.uid, course['id']))
+        if cached:
+            record_metric('enrollment_cache_hit')
+            return True
+        record_metric('enrollment_cache_miss')
+        enrolled = repo().find_enrollment(self.uid, course['id']) is not None
+        if enrolled: remember_enrollment(self.uid, course['id'])
+        return enrolled
 
 @login_manager.user_loader
 def load_user(user_id):
     if not db: return None
+    with AUTH_CACHE_LOCK:
+        user_data = USER_CACHE.get(user_id)
+    if user_data:
+        record_metric('user_cache_hit')
+        return User(user_id, user_data)
+    record_metric('user_cache_miss')
     try:
-        user_doc = db.collection('users').document(user_id).get()
-        if user_doc.exists:
-            return User(user_id, user_doc.to_dict())
+        user_data = repo().get('users', user_id)
+        if user_data:
+            with AUTH_CACHE_LOCK:
+                USER_CACHE[user_id] = dict(user_data)
+            return User(user_id, user_data)
     except Exception as e:
         print(f"Error loading user {user_id}: {e}")
     return None
@@ -91,6 +526,14 @@ def _doc_to_dict(doc):
     doc_dict['id'] = doc.id
     return doc_dict
 
+# Process-wide counters (cache hits, classifier outcomes, ...) exposed at /admin/metrics.
+METRICS = Counter()
+METRICS_LOCK = threading.Lock()
+
+def record_metric(name, amount=1):
+    with METRICS_LOCK:
+        METRICS[name] += amount
+
 def check_db_connection(f):
     @wraps(f)
     def decorated_function(*args, **kwargs):
@@ -112,6 +555,175 @@ def admin_required(f):
 def allowed_file(filename):
     return '.' in filename and filename.rsplit('.', 1)[1].lower() in ALLOWED_EXTENSIONS
 
+# --- Media Ingestion ---
+# Uploads run side by side on a bounded pool. Blobs are named by a hash of their content, so the same
+# asset uploaded twice maps to one object and the second upload is skipped by Storage itself.
+MEDIA_UPLOAD_EXECUTOR = ThreadPoolExecutor(max_workers=int(os.getenv("MEDIA_UPLOAD_WORKERS", 6)), thread_name_prefix='media-upload')
+MEDIA_HASH_CHUNK_BYTES = 1024 * 1024
+
+class MediaUploadError(Exception):
+    def __init__(self, filename):
+        super().__init__(f"Could not upload {filename}")
+        self.filename = filename
+
+def store_media_file(file, prefix):
+    # Werkzeug spools large uploads to disk, so hashing and uploading both read in chunks, never whole.
+    digest = hashlib.sha256()
+    for chunk in iter(lambda: file.stream.read(MEDIA_HASH_CHUNK_BYTES), b''):
+        digest.update(chunk)
+    file.stream.seek(0)
+    blob = storage.bucket().blob(f"{prefix}/{digest.hexdigest()}{os.path.splitext(file.filename)[1].lower()}")
+    try:
+        # One request: create only if absent, already public.
+        blob.upload_from_file(file.stream, content_type=file.content_type, if_generation_match=0, predefined_acl='publicRead')
+    except PreconditionFailed:
+        pass  # identical content is already stored under this name
+    return blob.public_url
+
+def ingest_media(files, prefix):
+    """Uploads the allowed files concurrently and returns (image_urls, audio_urls) in the order given."""
+    files = [f for f in files if f and f.filename != '' and allowed_file(f.filename)]
+    futures = [MEDIA_UPLOAD_EXECUTOR.submit(store_media_file, f, prefix) for f in files]
+    image_urls, audio_urls = [], []
+    for file, future in zip(files, futures):
+        try:
+            url = future.result()
+        except Exception as e:
+            print(f"Error uploading file {file.filename} to Firebase Storage: {e}")
+            raise MediaUploadError(file.filename)
+        content_type = file.content_type or ''
+        if content_type.startswith('image/'): image_urls.append(url)
+        elif content_type.startswith('audio/'): audio_urls.append(url)
+    return image_urls, audio_urls
+
+# --- Direct Uploads ---
+# The browser PUTs media straight to Storage with a short-lived signed URL, so large audio never counts
+# against MAX_CONTENT_LENGTH or the serverless body limit. The chapter form then sends only object names,
+# which finalize_direct_uploads checks before any URL is attached to a step.
+DIRECT_UPLOAD_URL_TTL = datetime.timedelta(minutes=int(os.getenv("DIRECT_UPLOAD_URL_TTL_MINUTES", 15)))
+DIRECT_UPLOAD_MAX_BYTES = int(os.getenv("DIRECT_UPLOAD_MAX_BYTES", 200 * 1024 * 1024))
+DIRECT_UPLOAD_MAX_FILES = 50
+# Set for a local fake GCS server (e.g. fake-gcs-server); the storage client already honours it for API calls.
+STORAGE_EMULATOR_HOST = os.getenv("STORAGE_EMULATOR_HOST")
+
+def direct_upload_prefix(course_id):
+    return f"course_media/{course_id}/"
+
+def direct_upload_headers(size):
+    """Headers the signature covers; the browser must send exactly these with its PUT."""
+    return {'x-goog-acl': 'public-read', 'x-goog-content-length-range': f"0,{min(size, DIRECT_UPLOAD_MAX_BYTES)}"}
+
+def sign_direct_upload(course_id, filename, content_type, size):
+    blob = storage.bucket().blob(f"{direct_upload_prefix(course_id)}{uuid.uuid4().hex}{os.path.splitext(filename)[1].lower()}")
+    headers = direct_upload_headers(size)
+    options = {'api_access_endpoint': STORAGE_EMULATOR_HOST} if STORAGE_EMULATOR_HOST else {}
+    url = blob.generate_signed_url(version='v4', expiration=DIRECT_UPLOAD_URL_TTL, method='PUT',
+                                   content_type=content_type, headers=headers, **options)
+    return {'object_name': blob.name, 'upload_url': url, 'headers': {'Content-Type': content_type, **headers}}
+
+def _verified_upload(course_id, object_name):
+    if not isinstance(object_name, str) or not object_name.startswith(direct_upload_prefix(course_id)) or '..' in object_name:
+        raise MediaUploadError(str(object_name))
+    blob = storage.bucket().get_blob(object_name)
+    if blob is None:
+        raise MediaUploadError(os.path.basename(object_name))
+    return blob
+
+def finalize_direct_uploads(course_id, object_names):
+    """Confirms each uploaded object exists under the course prefix and returns (image_urls, audio_urls) in order."""
+    object_names = object_names[:DIRECT_UPLOAD_MAX_FILES]
+    futures = [MEDIA_UPLOAD_EXECUTOR.submit(_verified_upload, course_id, name) for name in object_names]
+    image_urls, audio_urls = [], []
+    for name, future in zip(object_names, futures):
+        try:
+            blob = future.result()
+        except MediaUploadError:
+            raise
+        except Exception as e:
+            print(f"Error verifying uploaded object {name}: {e}")
+            raise MediaUploadError(os.path.basename(str(name)))
+        content_type = blob.content_type or ''
+        if content_type.startswith('image/'): image_urls.append(blob.public_url)
+        elif content_type.startswith('audio/'): audio_urls.append(blob.public_url)
+    return image_urls, audio_urls
+
+# --- Image Variants ---
+# Every stored image gets WebP copies at a few fixed widths, named after the source object, so cards
+# and the chat view can pick a small one through srcset. The original stays as the <img> fallback.
+IMAGE_VARIANT_WIDTHS = (320, 640, 1280)
+IMAGE_VARIANT_QUALITY = 80
+LEGACY_UPLOADS_PREFIX = "legacy_uploads"
+
+def storage_object_for_url(url):
+    """Maps a media URL to (object_name, loader) for our bucket or the legacy static/uploads folder, else None."""
+    if not url: return None
+    bucket = storage.bucket()
+    bucket_prefix = f"https://storage.googleapis.com/{bucket.name}/"
+    if url.startswith(bucket_prefix):
+        object_name = unquote(url[len(bucket_prefix):].split('?')[0])
+        return object_name, lambda: bucket.blob(object_name).download_as_bytes()
+    if '/static/uploads/' in url or url.startswith('static/uploads/'):
+        filename = os.path.basename(unquote(url.split('?')[0]))
+        path = os.path.join(app.root_path, app.config['UPLOAD_FOLDER'], filename)
+        def load():
+            with open(path, 'rb') as f: return f.read()
+        return f"{LEGACY_UPLOADS_PREFIX}/{filename}", load
+    return None
+
+def build_image_variants(data, object_name):
+    """Encodes and stores the WebP widths of one image; returns [{'width', 'url'}], narrowest first."""
+    bucket = storage.bucket()
+    stem = os.path.splitext(object_name)[0]
+    with Image.open(io.BytesIO(data)) as source:
+        image = ImageOps.exif_transpose(source)
+        image = image.convert('RGBA' if image.mode in ('RGBA', 'LA', 'P') else 'RGB')
+        widths = [w for w in IMAGE_VARIANT_WIDTHS if w < image.width] or [image.width]
+        variants = []
+        for width in widths:
+            resized = image if width == image.width else image.resize((width, max(1, round(image.height * width / image.width))), Image.Resampling.LANCZOS)
+            buffer = io.BytesIO()
+            resized.save(buffer, 'WEBP', quality=IMAGE_VARIANT_QUALITY, method=4)
+            blob = bucket.blob(f"{stem}_w{width}.webp")
+            try:
+                blob.upload_from_string(buffer.getvalue(), content_type='image/webp', if_generation_match=0, predefined_acl='publicRead')
+            except PreconditionFailed:
+                pass  # the source is content-addressed, so an existing variant is identical
+            variants.append({'width': width, 'url': blob.public_url})
+    return variants
+
+def image_variants_for(urls):
+    """Builds variants for each image URL concurrently; returns {url: variants}, leaving out any that fail."""
+    urls = list(dict.fromkeys(u for u in urls if u))
+    sources = {url: storage_object_for_url(url) for url in urls}
+    futures = {url: MEDIA_UPLOAD_EXECUTOR.submit(lambda src: build_image_variants(src[1](), src[0]), source)
+               for url, source in sources.items() if source}
+    variants = {}
+    for url, future in futures.items():
+        try:
+            variants[url] = future.result()
+        except Exception as e:
+            print(f"Error building image variants for {url}: {e}")
+    return variants
+
+@app.template_filter('srcset')
+def srcset_filter(variants):
+    return ', '.join(f"{v['url']} {v['width']}w" for v in variants or [])
+
+def assign_media_urls(parsed_data, image_urls, audio_urls, old_media_map=None, image_variants=None):
+    """Hands uploaded URLs to MEDIA steps in order; a step with no new upload keeps its previous URL."""
+    image_iterator, audio_iterator = iter(image_urls), iter(audio_urls)
+    for step in parsed_data.get('steps', []):
+        if step.get('type') == 'MEDIA':
+            assigned_url = (old_media_map or {}).get(step.get('alt_text'))
+            if step.get('media_type') == 'image':
+                assigned_url = next(image_iterator, assigned_url)
+            elif step.get('media_type') == 'audio':
+                assigned_url = next(audio_iterator, assigned_url)
+            step['media_url'] = assigned_url
+            variants = (image_variants or {}).get(assigned_url) if step.get('media_type') == 'image' else None
+            if variants: step['media_variants'] = variants
+            else: step.pop('media_variants', None)
+
 # --- AI and Parsing Functions ---
 PARSER_PROMPT = """
 You are a precise curriculum parsing agent. Your task is to convert a teacher's lesson script into a structured JSON object. You MUST follow these rules exactly.
@@ -132,20 +744,121 @@ TUTOR_PROMPT_TEMPLATE = {
 }
 INTENT_CLASSIFIER_PROMPT = "You are an intent classification agent. Your task is to analyze a user's input during a lesson and determine their intent. The user's input is: '{}'. The available media descriptions in this lesson are: {}. You MUST respond with a single, specific JSON object. Choose ONE of the following intents:\n\n1.  If the user is asking a general question about the lesson content, respond with:\n    {{\"intent\": \"QNA\", \"query\": \"the user's original question\"}}\n\n2.  If the user is asking to see a specific piece of media again AND their request matches one of the available media descriptions, respond with:\n    {{\"intent\": \"MEDIA_REQUEST\", \"alt_text\": \"the matching media description from the list\"}}\n\n3.  If the user's request is unclear or doesn't fit the above, default to a general question:\n    {{\"intent\": \"QNA\", \"query\": \"the user's original question\"}}\n\nUser Input: '{}'"
 
+TUTOR_UNCONFIGURED_REPLY = "AI Tutor is not configured."
+TUTOR_EMPTY_REPLY = "Let's try that another way."
+TUTOR_ERROR_REPLY = "I seem to be having a little trouble thinking. Could you try again?"
+
 def get_tutor_response(full_prompt):
-    if not os.getenv("GEMINI_API_KEY"): return "AI Tutor is not configured."
+    if not os.getenv("GEMINI_API_KEY"): return TUTOR_UNCONFIGURED_REPLY
     try:
         model = genai.GenerativeModel('gemini-1.5-pro-latest')
         response = model.generate_content(full_prompt)
-        return response.text if response.text else "Let's try that another way."
+        return response.text if response.text else TUTOR_EMPTY_REPLY
     except Exception as e:
         print(f"Error getting tutor response: {e}")
-        return "I seem to be having a little trouble thinking. Could you try again?"
+        return TUTOR_ERROR_REPLY
 
-def parse_lesson_script(script_text):
+def stream_tutor_response(full_prompt):
+    """Yields the tutor's reply in pieces as Gemini produces them."""
     if not os.getenv("GEMINI_API_KEY"):
-        print("Warning: GEMINI_API_KEY not set. Using basic parser.")
-        return {'steps': [{'type': 'CONTENT', 'text': script_text}]}
+        yield TUTOR_UNCONFIGURED_REPLY
+        return
+    produced_text = False
+    try:
+        model = genai.GenerativeModel('gemini-1.5-pro-latest')
+        for chunk in model.generate_content(full_prompt, stream=True):
+            if chunk.text:
+                produced_text = True
+                yield chunk.text
+        if not produced_text:
+            yield TUTOR_EMPTY_REPLY
+    except Exception as e:
+        print(f"Error streaming tutor response: {e}")
+        yield TUTOR_ERROR_REPLY
+
+# The tag grammar is small and fixed, so scripts are parsed locally in one pass. Text between tags
+# becomes CONTENT; each tag becomes one step. Only a tag the local parser cannot read (an unknown
+# name, a missing ANSWER, an unclosed bracket) is sent to the LLM, and only that tag's text.
+LESSON_TAG_START = re.compile(r"\[([A-Za-z_]+):")
+MCQ_OPTION = re.compile(r"(?:^|\s|,)\(?([A-Z])\)\s*")
+
+class UnparsedBlock(Exception):
+    """Raised for a tag the local grammar cannot read; the caller hands its text to the LLM."""
+
+def _tag_attribute(body, *names):
+    """Reads alt="..."-style attributes, quoted or bare; falls back to the whole body when none is named."""
+    for name in names:
+        match = re.search(rf"\b{name}\s*=\s*(?:\"([^\"]*)\"|'([^']*)'|“([^”]*)”|(.+))", body, re.S)
+        if match: return next(v for v in match.groups() if v is not None).strip()
+    return body.strip() or None
+
+def _parse_mcq(body):
+    question_part, options_sep, rest = body.partition('OPTIONS:')
+    options_part, answer_sep, answer_part = rest.rpartition('ANSWER:')
+    if not options_sep or not answer_sep: raise UnparsedBlock(body)
+    markers = list(MCQ_OPTION.finditer(options_part))
+    # Letters must run A, B, C...: "A) Vitamin C) B) Iron" has a marker inside an option, which only the LLM can untangle.
+    if [m.group(1) for m in markers] != [chr(ord('A') + i) for i in range(len(markers))]: raise UnparsedBlock(body)
+    options = {}
+    for marker, following in zip(markers, markers[1:] + [None]):
+        text = options_part[marker.end():following.start() if following else len(options_part)].strip().rstrip(',').strip()
+        options[marker.group(1)] = text
+    answer = re.match(r"\s*\(?([A-Z])\b", answer_part)
+    if len(options) < 2 or not answer or answer.group(1) not in options or not question_part.strip():
+        raise UnparsedBlock(body)
+    return {'type': 'QUESTION_MCQ', 'question': question_part.strip(), 'options': options, 'answer': answer.group(1)}
+
+def _parse_short_answer(body):
+    question_part, sep, keywords_part = body.partition('KEYWORDS:')
+    keywords = [k.strip() for k in keywords_part.split(',') if k.strip()]
+    if not sep or not keywords or not question_part.strip(): raise UnparsedBlock(body)
+    return {'type': 'QUESTION_SA', 'question': question_part.strip(), 'keywords': keywords}
+
+def _parse_lesson_tag(name, body):
+    if name == 'IMAGE':
+        alt_text = _tag_attribute(body, 'alt', 'description')
+        if not alt_text: raise UnparsedBlock(body)
+        return {'type': 'MEDIA', 'media_type': 'image', 'alt_text': alt_text}
+    if name == 'AUDIO':
+        alt_text = _tag_attribute(body, 'description', 'alt')
+        if not alt_text: raise UnparsedBlock(body)
+        return {'type': 'MEDIA', 'media_type': 'audio', 'alt_text': alt_text}
+    if name == 'QUESTION': return _parse_mcq(body)
+    if name == 'QUESTION_SA': return _parse_short_answer(body)
+    raise UnparsedBlock(body)
+
+def _tag_end(script_text, start):
+    """Index of the bracket closing the tag opened at start, allowing balanced brackets inside it; -1 if unclosed."""
+    depth = 0
+    for i in range(start, len(script_text)):
+        if script_text[i] == '[': depth += 1
+        elif script_text[i] == ']':
+            depth -= 1
+            if depth == 0: return i
+    return -1
+
+def scan_lesson_script(script_text):
+    """Splits a script into ('step', step) and ('block', raw_text) items, the latter for the LLM to parse."""
+    items, position = [], 0
+    def add_text(text):
+        text = re.sub(r"\n{3,}", "\n\n", text).strip()
+        if text: items.append(('step', {'type': 'CONTENT', 'text': text}))
+    for match in LESSON_TAG_START.finditer(script_text):
+        if match.start() < position: continue
+        end = _tag_end(script_text, match.start())
+        add_text(script_text[position:match.start()])
+        if end == -1:
+            items.append(('block', script_text[match.start():]))
+            return items
+        try:
+            items.append(('step', _parse_lesson_tag(match.group(1).upper(), script_text[match.end():end])))
+        except UnparsedBlock:
+            items.append(('block', script_text[match.start():end + 1]))
+        position = end + 1
+    add_text(script_text[position:])
+    return items
+
+def parse_lesson_script_with_llm(script_text):
     try:
         model = genai.GenerativeModel('gemini-1.5-pro-latest')
         response = model.generate_content(PARSER_PROMPT + script_text)
@@ -156,40 +869,723 @@ def parse_lesson_script(script_text):
         print(f"Error during parsing: {e}")
         return None
 
-def _get_or_create_rag_retriever(lesson_id, lesson_script):
-    if lesson_id in RAG_RETRIEVERS: return RAG_RETRIEVERS[lesson_id]
-    if not os.getenv("GEMINI_API_KEY"): return None
-    text_chunks = [chunk for chunk in lesson_script.split('\n\n') if chunk.strip()]
-    if not text_chunks: return None
+def block_hash(text):
+    """Content hash shared by parsed blocks, embedded chunks and cached tutor prompts."""
+    return hashlib.sha256((text or '').encode('utf-8')).hexdigest()[:32]
+
+# LLM-parsed blocks are also kept on the lesson (parsed_blocks_json), so an edit that leaves such a
+# block alone reuses its steps instead of calling the model again.
+PARSED_BLOCK_CACHE = LRUCache(maxsize=int(os.getenv("PARSED_BLOCK_CACHE_SIZE", 2048)))
+PARSED_BLOCK_CACHE_LOCK = threading.Lock()
+
+def parse_lesson_blocks(script_text, known_blocks=None):
+    """Returns (parsed_data, llm_blocks): the steps, and {block hash: steps} for every block the LLM parsed."""
+    steps, llm_blocks = [], {}
+    for kind, item in scan_lesson_script(script_text or ''):
+        if kind == 'step':
+            steps.append(item)
+            continue
+        key = block_hash(item)
+        block_steps = (known_blocks or {}).get(key)
+        if block_steps is None:
+            with PARSED_BLOCK_CACHE_LOCK:
+                block_steps = PARSED_BLOCK_CACHE.get(key)
+        if block_steps is None:
+            if not os.getenv("GEMINI_API_KEY"):
+                print("Warning: GEMINI_API_KEY not set. Keeping an unreadable tag as text.")
+                steps.append({'type': 'CONTENT', 'text': item})
+                continue
+            record_metric('parse_llm_block')
+            parsed_block = parse_lesson_script_with_llm(item)
+            if not parsed_block: return None, {}
+            block_steps = parsed_block['steps']
+        else:
+            record_metric('parse_block_cache_hit')
+        with PARSED_BLOCK_CACHE_LOCK:
+            PARSED_BLOCK_CACHE[key] = block_steps
+        llm_blocks[key] = block_steps
+        steps.extend(dict(step) for step in block_steps)
+    record_metric('parse_script')
+    return {'steps': steps}, llm_blocks
+
+def _script_hash(script_text):
+    return hashlib.sha256((script_text or '').encode('utf-8')).hexdigest()
+
+def _split_rag_chunks(script_text):
+    return [chunk for chunk in (script_text or '').split('\n\n') if chunk.strip()]
+
+def _build_rag_index(text_chunks, vectors):
+    """A lesson's retrieval index: chunk texts plus one contiguous, read-only float32 row per chunk."""
+    matrix = np.ascontiguousarray(vectors, dtype=np.float32)
+    matrix.setflags(write=False)
+    return {'chunks': tuple(text_chunks), 'matrix': matrix}
+
+def _load_persisted_embeddings(lesson_id, script_hash, text_chunks):
+    """Returns (rag_index, reusable): the stored index if the script is unchanged, else None plus
+    {chunk hash: vector} for the stored chunks an edit can keep."""
+    if not db: return None, {}
     try:
-        result = genai.embed_content(model='models/text-embedding-004', content=text_chunks, task_type="RETRIEVAL_DOCUMENT")
-        embeddings = result['embedding']
-        rag_data = [{'text': chunk, 'embedding': embeddings[i]} for i, chunk in enumerate(text_chunks)]
-        RAG_RETRIEVERS[lesson_id] = rag_data
-        return rag_data
+        record_doc = db.collection('lesson_embeddings').document(lesson_id).get()
     except Exception as e:
-        print(f"Error creating RAG embeddings: {e}")
-        return None
+        print(f"Error loading stored embeddings for lesson {lesson_id}: {e}")
+        return None, {}
+    if not record_doc.exists: return None, {}
+    record = record_doc.to_dict()
+    if record.get('model') != RAG_EMBEDDING_MODEL: return None, {}
+    dimensions = record.get('dimensions') or 0
+    vectors = np.frombuffer(record.get('vectors') or b'', dtype=np.float32)
+    if not dimensions or vectors.size % dimensions: return None, {}
+    vectors = vectors.reshape(-1, dimensions)
+    if record.get('script_hash') == script_hash and len(vectors) == len(text_chunks):
+        return _build_rag_index(text_chunks, vectors), {}
+    chunk_hashes = record.get('chunk_hashes') or []
+    return None, dict(zip(chunk_hashes, vectors)) if len(chunk_hashes) == len(vectors) else {}
+
+def _persist_embeddings(lesson_id, script_hash, rag_index):
+    if not db: return
+    matrix = rag_index['matrix']
+    vectors = matrix.tobytes()
+    if len(vectors) > RAG_PERSIST_MAX_BYTES:
+        print(f"Embeddings for lesson {lesson_id} are too large to store ({len(vectors)} bytes); keeping them in memory only.")
+        return
+    try:
+        db.collection('lesson_embeddings').document(lesson_id).set({
+            'script_hash': script_hash, 'model': RAG_EMBEDDING_MODEL, 'dimensions': matrix.shape[1],
+            'chunk_count': matrix.shape[0], 'chunk_hashes': [block_hash(c) for c in rag_index['chunks']],
+            'vectors': vectors, 'updated_at': firestore.SERVER_TIMESTAMP
+        })
+    except Exception as e:
+        print(f"Error storing embeddings for lesson {lesson_id}: {e}")
 
-def answer_question_with_rag(question, rag_data):
-    if not rag_data: return "I'm sorry, I don't have enough information to answer that."
+def invalidate_rag_retriever(lesson_id):
+    with RAG_RETRIEVERS_LOCK:
+        RAG_RETRIEVERS.pop(lesson_id, None)
+    if db:
+        try:
+            db.collection('lesson_embeddings').document(lesson_id).delete()
+        except Exception as e:
+            print(f"Error deleting stored embeddings for lesson {lesson_id}: {e}")
+
+def _embed_documents(text_chunks):
+    embeddings = []
+    for start in range(0, len(text_chunks), EMBED_BATCH_SIZE):
+        batch = text_chunks[start:start + EMBED_BATCH_SIZE]
+        embeddings.extend(genai.embed_content(model=RAG_EMBEDDING_MODEL, content=batch, task_type="RETRIEVAL_DOCUMENT")['embedding'])
+    return embeddings
+
+def lesson_index_is_current(lesson_id, lesson_script):
+    if not _split_rag_chunks(lesson_script): return True
+    script_hash = _script_hash(lesson_script)
+    with RAG_RETRIEVERS_LOCK:
+        cached = RAG_RETRIEVERS.get(lesson_id)
+    if cached and cached[0] == script_hash: return True
+    if not db: return False
     try:
-        query_embedding = genai.embed_content(model='models/text-embedding-004', content=question, task_type="RETRIEVAL_QUERY")['embedding']
+        record_doc = db.collection('lesson_embeddings').document(lesson_id).get(field_paths=['script_hash', 'model'])
     except Exception as e:
-        print(f"Error embedding RAG query: {e}")
-        return "I had trouble understanding your question. Please try rephrasing."
+        print(f"Error checking stored embeddings for lesson {lesson_id}: {e}")
+        return False
+    return record_doc.exists and record_doc.get('script_hash') == script_hash and record_doc.get('model') == RAG_EMBEDDING_MODEL
 
-    def dot_product(v1, v2): return sum(x*y for x, y in zip(v1, v2))
+def schedule_lesson_index(lesson_id, lesson_script):
+    """Chunks and embeds a lesson off the request thread so the first student question is a lookup."""
+    if not os.getenv("GEMINI_API_KEY") or not _split_rag_chunks(lesson_script): return
+    BACKGROUND_EXECUTOR.submit(_get_or_create_rag_retriever, lesson_id, lesson_script)
 
-    for item in rag_data:
-        item['similarity'] = dot_product(item['embedding'], query_embedding)
+def _get_or_create_rag_retriever(lesson_id, lesson_script):
+    script_hash = _script_hash(lesson_script)
+    with RAG_RETRIEVERS_LOCK:
+        cached = RAG_RETRIEVERS.get(lesson_id)
+    if cached and cached[0] == script_hash: return cached[1]
 
-    sorted_data = sorted(rag_data, key=lambda x: x['similarity'], reverse=True)
-    top_chunks = [item['text'] for item in sorted_data[:3]]
-    context = "\n---\n".join(top_chunks)
-    
-    rag_prompt = f"Based ONLY on the following context, provide a concise answer to the user's question. If the context doesn't contain the answer, say \"That's a great question, but it's not covered in this chapter's material.\"\n\nCONTEXT:\n{context}\n\nUSER'S QUESTION:\n{question}"
-    return get_tutor_response(rag_prompt)
+    text_chunks = _split_rag_chunks(lesson_script)
+    if not text_chunks: return None
+    rag_index, reusable = _load_persisted_embeddings(lesson_id, script_hash, text_chunks)
+    if rag_index is None:
+        if not os.getenv("GEMINI_API_KEY"): return None
+        if cached:
+            reusable.update(zip(map(block_hash, cached[1]['chunks']), cached[1]['matrix']))
+        # After an edit only the chunks whose text changed are embedded again.
+        missing = list(dict.fromkeys(c for c in text_chunks if block_hash(c) not in reusable))
+        try:
+            if missing: reusable.update(zip(map(block_hash, missing), _embed_documents(missing)))
+        except Exception as e:
+            print(f"Error creating RAG embeddings: {e}")
+            return None
+        record_metric('embedding_chunks_reused', len(text_chunks) - len(missing))
+        rag_index = _build_rag_index(text_chunks, [reusable[block_hash(c)] for c in text_chunks])
+        _persist_embeddings(lesson_id, script_hash, rag_index)
+
+    with RAG_RETRIEVERS_LOCK:
+        try:
+            RAG_RETRIEVERS[lesson_id] = (script_hash, rag_index)
+        except ValueError:
+            print(f"Embeddings for lesson {lesson_id} exceed RAG_CACHE_MAX_BYTES; not caching in memory.")
+    return rag_index
+
+def top_k_chunks(rag_index, query_vectors, k=RAG_TOP_K):
+    """Scores all chunks against every query in one matrix product and returns the k best chunk texts per query, best first.
+
+    Only local arrays are written, so one cached index can serve concurrent requests.
+    """
+    queries = np.atleast_2d(np.asarray(query_vectors, dtype=np.float32))
+    matrix = rag_index['matrix']
+    k = min(k, matrix.shape[0])
+    if k == 0: return [[] for _ in range(queries.shape[0])]
+    scores = queries @ matrix.T
+    candidates = np.argpartition(scores, -k, axis=1)[:, -k:]
+    order = np.argsort(-np.take_along_axis(scores, candidates, axis=1), axis=1)
+    best = np.take_along_axis(candidates, order, axis=1)
+    return [[rag_index['chunks'][i] for i in row] for row in best]
+
+def build_rag_prompts(questions, rag_index):
+    """Batch form of build_rag_prompt: embeds all questions in one call and retrieves context for each."""
+    if not rag_index: return [(None, "I'm sorry, I don't have enough information to answer that.")] * len(questions)
+    try:
+        query_embeddings = genai.embed_content(model=RAG_EMBEDDING_MODEL, content=list(questions), task_type="RETRIEVAL_QUERY")['embedding']
+    except Exception as e:
+        print(f"Error embedding RAG query: {e}")
+        return [(None, "I had trouble understanding your question. Please try rephrasing.")] * len(questions)
+
+    prompts = []
+    for question, top_chunks in zip(questions, top_k_chunks(rag_index, query_embeddings)):
+        context = "\n---\n".join(top_chunks)
+        rag_prompt = f"Based ONLY on the following context, provide a concise answer to the user's question. If the context doesn't contain the answer, say \"That's a great question, but it's not covered in this chapter's material.\"\n\nCONTEXT:\n{context}\n\nUSER'S QUESTION:\n{question}"
+        prompts.append((rag_prompt, None))
+    return prompts
+
+def build_rag_prompt(question, rag_index):
+    """Returns (prompt, None) for the tutor model, or (None, reply) when no prompt can be built."""
+    return build_rag_prompts([question], rag_index)[0]
+
+# --- Tutor Response Cache ---
+# Lesson-flow replies depend only on the lesson content, so they are shared by every student.
+# Entries are keyed by (lesson id, hash of the step's prompt, prompt version), so an edit only
+# invalidates the replies for steps and chunks whose text actually changed. Each entry holds a
+# few variants so repeat visits don't read identically. Bump TUTOR_PROMPT_VERSION whenever
+# TUTOR_PROMPT_TEMPLATE changes.
+TUTOR_PROMPT_VERSION = 1
+TUTOR_RESPONSE_VARIANTS = int(os.getenv("TUTOR_RESPONSE_VARIANTS", 3))
+TUTOR_RESPONSE_CACHE = LRUCache(maxsize=int(os.getenv("TUTOR_RESPONSE_CACHE_SIZE", 4096)))
+TUTOR_RESPONSE_CACHE_LOCK = threading.Lock()
+
+def _content_chunks(step):
+    return [c for c in step.get('text', '').split('\n\n') if c.strip()]
+
+def _tutor_prompt_for_step(step, chunk_index=0):
+    step_type = step.get('type')
+    if step_type == 'CONTENT':
+        return TUTOR_PROMPT_TEMPLATE['CONTENT'].format(_content_chunks(step)[chunk_index])
+    if step_type == 'MEDIA':
+        prompt_template_key = f"MEDIA_{step.get('media_type', 'image').upper()}"
+        prompt_template = TUTOR_PROMPT_TEMPLATE.get(prompt_template_key, TUTOR_PROMPT_TEMPLATE['MEDIA_IMAGE'])
+        return prompt_template.format(step.get('alt_text', ''))
+    if step_type in ['QUESTION_MCQ', 'QUESTION_SA']:
+        return TUTOR_PROMPT_TEMPLATE['QUESTION'].format(step.get('question', ''))
+    return None
+
+def tutor_cache_key(lesson, step, chunk_index):
+    return _tutor_cache_key_for_prompt(lesson['id'], _tutor_prompt_for_step(step, chunk_index))
+
+def _tutor_cache_key_for_prompt(lesson_id, prompt):
+    return (lesson_id, block_hash(prompt), TUTOR_PROMPT_VERSION)
+
+def _tutor_cache_ref(key):
+    lesson_id, prompt_hash, prompt_version = key
+    return db.collection('tutor_responses').document(f"{lesson_id}_{prompt_hash}_p{prompt_version}")
+
+def lesson_tutor_cache_keys(lesson, lesson_steps):
+    """Every (step, chunk) prompt of a lesson with its cache key, in lesson order."""
+    keys = []
+    for step in lesson_steps:
+        chunk_count = len(_content_chunks(step)) if step.get('type') == 'CONTENT' else 1
+        for chunk_index in range(chunk_count):
+            prompt = _tutor_prompt_for_step(step, chunk_index)
+            if prompt: keys.append((prompt, tutor_cache_key(lesson, step, chunk_index)))
+    return keys
+
+def get_tutor_response_variants(key):
+    with TUTOR_RESPONSE_CACHE_LOCK:
+        variants = TUTOR_RESPONSE_CACHE.get(key)
+    if variants is not None or not db: return variants or []
+    try:
+        cache_doc = _tutor_cache_ref(key).get()
+    except Exception as e:
+        print(f"Error reading tutor response cache: {e}")
+        return []
+    variants = (cache_doc.to_dict().get('variants', []) if cache_doc.exists else [])[:TUTOR_RESPONSE_VARIANTS]
+    # A miss isn't remembered: prewarm or another instance may fill the document at any moment.
+    if variants:
+        with TUTOR_RESPONSE_CACHE_LOCK:
+            TUTOR_RESPONSE_CACHE[key] = variants
+    return variants
+
+def get_cached_tutor_response(key):
+    variants = get_tutor_response_variants(key)
+    return random.choice(variants) if variants else None
+
+def store_tutor_response(key, text):
+    if not text or text.endswith((TUTOR_UNCONFIGURED_REPLY, TUTOR_EMPTY_REPLY, TUTOR_ERROR_REPLY)): return
+    variants = get_tutor_response_variants(key)
+    if text in variants or len(variants) >= TUTOR_RESPONSE_VARIANTS: return
+    if db:
+        cache_ref = _tutor_cache_ref(key)
+
+        # Several instances may be adding variants for the same prompt; the cap is checked against
+        # the stored array, not this instance's view of it.
+        @firestore.transactional
+        def append_variant(transaction):
+            snapshot = cache_ref.get(transaction=transaction)
+            stored = snapshot.to_dict().get('variants', []) if snapshot.exists else []
+            if text in stored or len(stored) >= TUTOR_RESPONSE_VARIANTS: return stored[:TUTOR_RESPONSE_VARIANTS]
+            transaction.set(cache_ref, {'lesson_id': key[0], 'variants': stored + [text]}, merge=True)
+            return stored + [text]
+
+        try:
+            variants = append_variant(db.transaction())
+        except Exception as e:
+            print(f"Error writing tutor response cache: {e}")
+            return
+    else:
+        variants = variants + [text]
+    with TUTOR_RESPONSE_CACHE_LOCK:
+        TUTOR_RESPONSE_CACHE[key] = variants
+
+def prewarm_tutor_responses(lesson):
+    """Generates the lesson-flow replies for every step and chunk ahead of the first student."""
+    if not os.getenv("GEMINI_API_KEY"): return
+    lesson_steps = json.loads(lesson.get('parsed_json') or '{}').get('steps', [])
+    for prompt, key in lesson_tutor_cache_keys(lesson, lesson_steps):
+        for _ in range(TUTOR_RESPONSE_VARIANTS - len(get_tutor_response_variants(key))):
+            store_tutor_response(key, get_tutor_response(prompt))
+
+def invalidate_tutor_responses(lesson_id, keep_keys=None):
+    """Drops cached replies for a lesson, except those whose key is in `keep_keys` (still used after an edit)."""
+    keep_keys = set(keep_keys or ())
+    with TUTOR_RESPONSE_CACHE_LOCK:
+        for key in [k for k in list(TUTOR_RESPONSE_CACHE.keys()) if k[0] == lesson_id and k not in keep_keys]:
+            TUTOR_RESPONSE_CACHE.pop(key, None)
+    if not db: return
+    keep_ids = {_tutor_cache_ref(k).id for k in keep_keys}
+    try:
+        for cache_doc in db.collection('tutor_responses').where('lesson_id', '==', lesson_id).select([]).stream():
+            if cache_doc.id not in keep_ids: cache_doc.reference.delete()
+    except Exception as e:
+        print(f"Error clearing tutor response cache for lesson {lesson_id}: {e}")
+
+# --- Compiled Lessons ---
+# Chat turns need the same derived views of a lesson over and over: the decoded steps, each CONTENT
+# step's chunks, the media by alt_text and every tutor prompt with its cache key. They are built once
+# per lesson version and shared by all requests; a new version gets a new entry.
+COMPILED_LESSON_CACHE = LRUCache(maxsize=int(os.getenv("COMPILED_LESSON_CACHE_SIZE", 256)))
+COMPILED_LESSON_CACHE_LOCK = threading.Lock()
+
+class CompiledLesson:
+    """Read-only, precomputed form of a lesson's parsed_json."""
+    __slots__ = ('steps', 'chunks', 'media', 'media_descriptions', 'step_count', 'prompts')
+
+    def __init__(self, lesson):
+        self.steps = tuple(json.loads(lesson.get('parsed_json') or '{}').get('steps', []))
+        self.step_count = len(self.steps)
+        self.chunks = tuple(tuple(_content_chunks(step)) if step.get('type') == 'CONTENT' else () for step in self.steps)
+        self.media = {}
+        for step in self.steps:
+            if step.get('type') == 'MEDIA' and step.get('alt_text'):
+                self.media.setdefault(step['alt_text'], step)
+        self.media_descriptions = list(self.media)
+        self.prompts = {}
+        for step_index, step in enumerate(self.steps):
+            for chunk_index in range(len(self.chunks[step_index]) if step.get('type') == 'CONTENT' else 1):
+                prompt = _tutor_prompt_for_step(step, chunk_index)
+                if prompt: self.prompts[(step_index, chunk_index)] = (prompt, _tutor_cache_key_for_prompt(lesson['id'], prompt))
+
+    def chunk_count(self, step_index):
+        return len(self.chunks[step_index]) if self.steps[step_index].get('type') == 'CONTENT' else 1
+
+    def tutor_prompt(self, step_index, chunk_index):
+        """(prompt, cache key) for one step and chunk, or (None, None) if it has no prompt."""
+        return self.prompts.get((step_index, chunk_index), (None, None))
+
+def compiled_lesson(lesson):
+    key = (lesson['id'], lesson.get('version', 0))
+    with COMPILED_LESSON_CACHE_LOCK:
+        compiled = COMPILED_LESSON_CACHE.get(key)
+    if compiled is None:
+        record_metric('compiled_lesson_miss')
+        compiled = CompiledLesson(lesson)
+        with COMPILED_LESSON_CACHE_LOCK:
+            COMPILED_LESSON_CACHE[key] = compiled
+    return compiled
+
+# --- Intent Classification ---
+# Most questions can be routed without the LLM: MEDIA_REQUEST is only valid when the input
+# names one of the lesson's own media descriptions, so keyword and fuzzy matching against
+# those descriptions settles the clear cases. Only an input that names media or asks to have it
+# shown, and asks no question, is routed to MEDIA_REQUEST locally. The model is asked only when
+# the local confidence falls below INTENT_LOCAL_CONFIDENCE. INTENT_EMBEDDING_MATCH=1 also lets a
+# vague "show me that again" be matched through the lesson's embeddings, which costs one
+# embedding call.
+INTENT_LOCAL_CONFIDENCE = float(os.getenv("INTENT_LOCAL_CONFIDENCE", 0.75))
+INTENT_EMBEDDING_MATCH = os.getenv("INTENT_EMBEDDING_MATCH", "0") == "1"
+MEDIA_NOUNS = {'picture', 'pic', 'image', 'photo', 'diagram', 'chart', 'figure', 'graph', 'illustration',
+               'audio', 'sound', 'clip', 'recording'}
+MEDIA_VERBS = {'show', 'display', 'view', 'play', 'replay'}
+QUESTION_WORDS = {'what', 'why', 'how', 'when', 'where', 'who', 'which', 'explain', 'define', 'difference', 'meaning', 'mean'}
+INTENT_STOP_WORDS = {'a', 'an', 'the', 'of', 'to', 'me', 'my', 'i', 'you', 'can', 'could', 'please', 'that', 'this', 'it', 'is',
+                     'was', 'and', 'with', 'for', 'in', 'on', 'one', 'some', 'want', 'would', 'like', 'let', 'us', 'again',
+                     'see', 'listen', 'hear'}
+
+def _intent_tokens(text):
+    return re.findall(r"[a-z0-9]+", (text or '').lower())
+
+def _media_match_score(content_tokens, alt_text):
+    alt_tokens = {t for t in _intent_tokens(alt_text) if t not in INTENT_STOP_WORDS}
+    if not alt_tokens or not content_tokens: return 0.0
+    matched = sum(1 for a in alt_tokens if any(a == t or difflib.SequenceMatcher(None, a, t).ratio() >= 0.8 for t in content_tokens))
+    phrase_ratio = difflib.SequenceMatcher(None, ' '.join(sorted(content_tokens)), ' '.join(sorted(alt_tokens))).ratio()
+    return max(matched / len(alt_tokens), phrase_ratio)
+
+def _media_match_from_embeddings(lesson_id, user_input, media_descriptions):
+    """Uses the lesson's in-memory embeddings, if already loaded, to find the media tag nearest the input."""
+    with RAG_RETRIEVERS_LOCK:
+        cached = RAG_RETRIEVERS.get(lesson_id)
+    if not cached or not os.getenv("GEMINI_API_KEY"): return None
+    try:
+        query_embedding = genai.embed_content(model=RAG_EMBEDDING_MODEL, content=user_input, task_type="RETRIEVAL_QUERY")['embedding']
+    except Exception as e:
+        print(f"Error embedding intent query: {e}")
+        return None
+    nearest_chunk = next(iter(top_k_chunks(cached[1], [query_embedding], k=1)[0]), '')
+    return next((alt for alt in media_descriptions if alt in nearest_chunk), None)
+
+def classify_intent_locally(user_input, media_descriptions, lesson_id=None):
+    """Returns (intent_data, confidence) from matching the input against the lesson's media descriptions."""
+    qna_intent = {"intent": "QNA", "query": user_input}
+    tokens = _intent_tokens(user_input)
+    if not media_descriptions or not tokens: return qna_intent, 1.0
+
+    wants_media = any(t in MEDIA_NOUNS or t in MEDIA_VERBS for t in tokens)
+    asks_question = '?' in user_input or any(t in QUESTION_WORDS for t in tokens)
+    content_tokens = {t for t in tokens if t not in INTENT_STOP_WORDS and t not in MEDIA_NOUNS and t not in MEDIA_VERBS}
+    best_alt, best_score = max(((alt, _media_match_score(content_tokens, alt)) for alt in media_descriptions), key=lambda pair: pair[1])
+
+    if not wants_media:
+        if asks_question: return qna_intent, 0.9
+        return qna_intent, 0.9 if best_score < 0.3 else 0.5
+    # "What does the diagram show?" names the media but asks about it; let the model decide.
+    if asks_question:
+        return ({"intent": "MEDIA_REQUEST", "alt_text": best_alt}, 0.5) if best_score >= 0.5 else (qna_intent, 0.4)
+    if best_score >= 0.5:
+        return {"intent": "MEDIA_REQUEST", "alt_text": best_alt}, 0.6 + 0.4 * best_score
+    if lesson_id and INTENT_EMBEDDING_MATCH:
+        embedded_alt = _media_match_from_embeddings(lesson_id, user_input, media_descriptions)
+        if embedded_alt: return {"intent": "MEDIA_REQUEST", "alt_text": embedded_alt}, 0.8
+    return qna_intent, 0.4
+
+def classify_intent_with_llm(user_input, media_descriptions):
+    prompt = INTENT_CLASSIFIER_PROMPT.format(user_input, media_descriptions, user_input)
+    try:
+        model = genai.GenerativeModel('gemini-1.5-pro-latest')
+        response = model.generate_content(prompt)
+        cleaned_response = response.text.strip().replace("```json", "").replace("```", "").strip()
+        return json.loads(cleaned_response)
+    except Exception as e:
+        print(f"Error classifying intent: {e}")
+        return {"intent": "QNA", "query": user_input}
+
+def classify_question_intent(user_input, media_descriptions, lesson_id=None):
+    intent_data, confidence = classify_intent_locally(user_input, media_descriptions, lesson_id)
+    if confidence >= INTENT_LOCAL_CONFIDENCE:
+        record_metric('intent_local')
+        return intent_data
+    record_metric('intent_llm')
+    return classify_intent_with_llm(user_input, media_descriptions)
+
+# --- Chapter Ingestion Jobs ---
+# Saving a chapter only stores a draft and enqueues a job; a worker then runs the slow parts as
+# separate stages (parse, media, save, index). Each finished stage is checkpointed, so a failure is
+# retried from the stage that failed rather than from the start. The queue is a local SQLite file
+# drained by an in-process worker thread (or `flask ingest-worker`). A serverless instance may be
+# frozen as soon as the response is sent, so on Vercel (or INGEST_BACKEND=inline) the same stages
+# run inside the request instead. Progress is mirrored on the lesson and its toc entry, which is
+# what manage_course polls. A new chapter stays a draft, hidden from students, until its save stage
+# runs, and a script the parser can't read fails the job at once rather than being retried.
+INGEST_BACKEND = os.getenv("INGEST_BACKEND", "inline" if os.getenv("VERCEL") else "sqlite")
+INGEST_DB_PATH = os.getenv("INGEST_DB_PATH", os.path.join(app.instance_path, 'jobs.sqlite3'))
+INGEST_SPOOL_DIR = os.getenv("INGEST_SPOOL_DIR", os.path.join(tempfile.gettempdir() if INGEST_BACKEND == 'inline' else app.instance_path, 'ingest_uploads'))
+INGEST_MAX_ATTEMPTS = int(os.getenv("INGEST_MAX_ATTEMPTS", 3))
+INGEST_RETRY_SECONDS = int(os.getenv("INGEST_RETRY_SECONDS", 10))
+INGEST_LEASE_SECONDS = int(os.getenv("INGEST_LEASE_SECONDS", 600))
+INGEST_POLL_SECONDS = 2
+# Inline ingestion dies with the request; a status older than the host's function timeout can't still be running.
+INGEST_INLINE_TIMEOUT_SECONDS = int(os.getenv("INGEST_INLINE_TIMEOUT_SECONDS", 300))
+INGEST_STAGES = ('parse', 'media', 'save', 'index')
+INGEST_STAGE_STATUS = {'parse': 'parsing', 'media': 'uploading_media', 'save': 'saving', 'index': 'indexing'}
+
+class IngestError(Exception):
+    """A stage failed; the message is shown to the creator if the job runs out of attempts."""
+
+class IngestRejected(IngestError):
+    """A stage failed in a way another attempt won't fix, so the job fails without retrying."""
+
+class IngestSuperseded(Exception):
+    """A newer edit of the chapter has already been saved; this job's older content must not replace it."""
+
+LESSON_PARSE_ERROR = 'The AI could not understand the lesson structure. Please check your tags and try again.'
+
+class SqliteJobQueue:
+    """Jobs as rows in a local SQLite file. A claimed job holds a lease, so one abandoned by a
+    crashed worker is picked up again once the lease runs out. Jobs that share a serial_key (one
+    chapter's edits) run one at a time, oldest first, whichever worker or process claims them."""
+
+    def __init__(self, path):
+        self.path = path
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        with self._connect() as conn:
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("CREATE TABLE IF NOT EXISTS jobs (id TEXT PRIMARY KEY, kind TEXT NOT NULL, payload TEXT NOT NULL, "
+                         "status TEXT NOT NULL, stage TEXT, attempts INTEGER NOT NULL DEFAULT 0, error TEXT, "
+                         "run_after REAL NOT NULL, lease_until REAL, created_at REAL NOT NULL, updated_at REAL NOT NULL)")
+            if 'serial_key' not in {row[1] for row in conn.execute("PRAGMA table_info(jobs)")}:
+                conn.execute("ALTER TABLE jobs ADD COLUMN serial_key TEXT")
+
+    def _connect(self):
+        return sqlite3.connect(self.path, timeout=10)
+
+    def enqueue(self, kind, payload, serial_key=None, job_id=None):
+        job_id, now = job_id or uuid.uuid4().hex, time.time()
+        with self._connect() as conn:
+            conn.execute("INSERT INTO jobs (id, kind, payload, status, serial_key, run_after, created_at, updated_at) "
+                         "VALUES (?, ?, ?, 'queued', ?, ?, ?, ?)", (job_id, kind, json.dumps(payload), serial_key, now, now, now))
+        return job_id
+
+    def claim(self):
+        now = time.time()
+        with self._connect() as conn:
+            conn.execute("BEGIN IMMEDIATE")
+            row = conn.execute("SELECT id, kind, payload, stage, attempts FROM jobs AS j "
+                               "WHERE ((status = 'queued' AND run_after <= ?) OR (status = 'running' AND lease_until < ?)) "
+                               "AND (serial_key IS NULL OR NOT EXISTS (SELECT 1 FROM jobs AS o WHERE o.serial_key = j.serial_key "
+                               "AND o.id != j.id AND ((o.status = 'running' AND o.lease_until >= ?) "
+                               "OR (o.status = 'queued' AND o.created_at < j.created_at)))) "
+                               "ORDER BY created_at LIMIT 1", (now, now, now)).fetchone()
+            if not row: return None
+            conn.execute("UPDATE jobs SET status = 'running', attempts = attempts + 1, lease_until = ?, updated_at = ? WHERE id = ?",
+                         (now + INGEST_LEASE_SECONDS, now, row[0]))
+        return {'id': row[0], 'kind': row[1], 'payload': json.loads(row[2]), 'stage': row[3], 'attempts': row[4] + 1}
+
+    def checkpoint(self, job):
+        with self._connect() as conn:
+            conn.execute("UPDATE jobs SET stage = ?, payload = ?, updated_at = ? WHERE id = ?",
+                         (job['stage'], json.dumps(job['payload']), time.time(), job['id']))
+
+    def retry(self, job, error):
+        delay = INGEST_RETRY_SECONDS * 2 ** (job['attempts'] - 1)
+        with self._connect() as conn:
+            conn.execute("UPDATE jobs SET status = 'queued', error = ?, run_after = ?, lease_until = NULL, updated_at = ? WHERE id = ?",
+                         (error, time.time() + delay, time.time(), job['id']))
+
+    def finish(self, job, error=None):
+        with self._connect() as conn:
+            conn.execute("UPDATE jobs SET status = ?, error = ?, lease_until = NULL, updated_at = ? WHERE id = ?",
+                         ('failed' if error else 'done', error, time.time(), job['id']))
+
+    def get(self, job_id):
+        with self._connect() as conn:
+            row = conn.execute("SELECT status, stage, attempts, error FROM jobs WHERE id = ?", (job_id,)).fetchone()
+        return dict(zip(('status', 'stage', 'attempts', 'error'), row)) if row else None
+
+INGEST_QUEUE = SqliteJobQueue(INGEST_DB_PATH) if INGEST_BACKEND == 'sqlite' else None
+INGEST_WAKE = threading.Event()
+INGEST_WORKER_LOCK = threading.Lock()
+ingest_worker_thread = None
+
+def _set_ingest_status(lesson_id, status, error=None, toc=False):
+    repo().update('lessons', lesson_id, {'ingest_status': status, 'ingest_error': error or firestore.DELETE_FIELD,
+                                         'ingest_updated_at': firestore.SERVER_TIMESTAMP})
+    if toc:
+        lesson = repo().get('lessons', lesson_id)
+        course = repo().get('courses', lesson['course_id'])
+        entry = next((e for e in get_course_toc(course) if e['id'] == lesson_id), None) or \
+            toc_entry(lesson_id, lesson.get('title'), lesson.get('chapter_number'), json.loads(lesson.get('parsed_json') or '{}'))
+        save_toc_entry(lesson['course_id'], {**entry, 'ingest_status': status})
+
+def _spool_uploads(files, job_key):
+    """Copies multipart uploads to local disk so the media stage can run after the request has ended."""
+    spooled = []
+    for index, file in enumerate(f for f in files if f and f.filename != '' and allowed_file(f.filename)):
+        path = os.path.join(INGEST_SPOOL_DIR, job_key, f"{index}{os.path.splitext(file.filename)[1].lower()}")
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        file.save(path)
+        spooled.append({'path': path, 'filename': file.filename, 'content_type': file.content_type})
+    return spooled
+
+def _discard_spooled_uploads(payload):
+    if payload.get('files'):
+        shutil.rmtree(os.path.dirname(payload['files'][0]['path']), ignore_errors=True)
+
+def _ingest_parse(payload, lesson):
+    parsed_data, llm_blocks = parse_lesson_blocks(payload['script'], json.loads(lesson.get('parsed_blocks_json') or '{}'))
+    if not parsed_data: raise IngestRejected(LESSON_PARSE_ERROR)
+    payload.update(parsed=parsed_data, llm_blocks=llm_blocks)
+
+def _ingest_media(payload, lesson):
+    course_id = lesson['course_id']
+    files = [FileStorage(stream=open(f['path'], 'rb'), filename=f['filename'], content_type=f['content_type']) for f in payload.get('files', [])]
+    try:
+        if payload.get('uploaded_media'):
+            image_urls, audio_urls = finalize_direct_uploads(course_id, payload['uploaded_media'])
+        else:
+            image_urls, audio_urls = ingest_media(files, f"course_media/{course_id}")
+    except MediaUploadError as e:
+        raise IngestError(f"Error uploading {e.filename}. Please try again.")
+    finally:
+        for f in files: f.close()
+    # The lesson still holds the previous version here, so steps without a new upload keep its media.
+    old_media_steps = [s for s in json.loads(lesson.get('parsed_json') or '{}').get('steps', []) if s.get('type') == 'MEDIA' and s.get('media_url')]
+    old_media_map = {s.get('alt_text'): s.get('media_url') for s in old_media_steps}
+    old_variants = {s['media_url']: s['media_variants'] for s in old_media_steps if s.get('media_variants')}
+    assign_media_urls(payload['parsed'], image_urls, audio_urls, old_media_map, {**old_variants, **image_variants_for(image_urls)})
+
+def _ingest_save(payload, lesson):
+    lesson_id, parsed_data = lesson['id'], payload['parsed']
+    lesson_ref = repo().ref('lessons', lesson_id)
+
+    # The version is taken from the document inside the transaction, so two saves never share one, and
+    # an edit queued earlier than the one already saved (a worker that lost its lease) is dropped.
+    @firestore.transactional
+    def save_version(transaction):
+        current = _doc_to_dict(lesson_ref.get(transaction=transaction))
+        if not current or current.get('ingest_queued_at', 0) > payload.get('queued_at', 0): return None
+        version = current.get('version', 0) + 1
+        transaction.update(lesson_ref, {
+            'title': payload['title'], 'raw_script': payload['script'], 'editor_html': payload['editor_html'],
+            'parsed_json': json.dumps(parsed_data), 'parsed_blocks_json': json.dumps(payload['llm_blocks']), 'version': version,
+            'ingest_queued_at': payload.get('queued_at', 0)
+        })
+        return version
+
+    version = save_version(repo().client.transaction())
+    repo().record_transaction(reads=1, writes=1, paths=[lesson_ref.path])
+    if version is None: raise IngestSuperseded()
+    course = repo().get('courses', lesson['course_id'])
+    get_course_toc(course)
+    save_toc_entry(course['id'], toc_entry(lesson_id, payload['title'], lesson['chapter_number'], parsed_data))
+    BACKGROUND_EXECUTOR.submit(invalidate_tutor_responses, lesson_id, [key for _, key in lesson_tutor_cache_keys(lesson, parsed_data['steps'])])
+    if course.get('status') == 'published':
+        BACKGROUND_EXECUTOR.submit(prewarm_tutor_responses, {**lesson, 'parsed_json': json.dumps(parsed_data), 'version': version})
+
+def _ingest_index(payload, lesson):
+    if not os.getenv("GEMINI_API_KEY") or not _split_rag_chunks(payload['script']): return
+    if INGEST_QUEUE is None:
+        # Inline, the request is already waiting on the model; embed after the response as before.
+        schedule_lesson_index(lesson['id'], payload['script'])
+        return
+    if _get_or_create_rag_retriever(lesson['id'], payload['script']) is None:
+        raise IngestError('The chapter was saved, but it could not be indexed for questions yet.')
+
+INGEST_STAGE_FUNCTIONS = {'parse': _ingest_parse, 'media': _ingest_media, 'save': _ingest_save, 'index': _ingest_index}
+
+def run_ingest_stages(job, checkpoint=None):
+    """Runs the stages after job['stage'] in order, recording each as it completes. Raises on the first failure."""
+    payload = job['payload']
+    remaining = INGEST_STAGES[INGEST_STAGES.index(job['stage']) + 1:] if job.get('stage') else INGEST_STAGES
+    for stage in remaining:
+        lesson = repo().get('lessons', payload['lesson_id'])
+        if not lesson:  # deleted while queued
+            _discard_spooled_uploads(payload)
+            return
+        repo().update('lessons', lesson['id'], {'ingest_status': INGEST_STAGE_STATUS[stage], 'ingest_updated_at': firestore.SERVER_TIMESTAMP})
+        try:
+            INGEST_STAGE_FUNCTIONS[stage](payload, lesson)
+        except IngestSuperseded:
+            print(f"Ingestion job {job['id']} for lesson {lesson['id']} was superseded by a newer edit.")
+            _discard_spooled_uploads(payload)
+            return
+        job['stage'] = stage
+        if checkpoint: checkpoint(job)
+    if repo().get('lessons', payload['lesson_id']):
+        repo().update('lessons', payload['lesson_id'], {'ingest_status': 'ready', 'ingest_error': firestore.DELETE_FIELD,
+                                                        'ingest_updated_at': firestore.SERVER_TIMESTAMP})
+    _discard_spooled_uploads(payload)
+
+def _ingest_error_message(e):
+    return str(e) if isinstance(e, IngestError) else 'Something went wrong while processing this chapter.'
+
+def process_ingest_job(job):
+    """Runs one claimed job in its own app context and either finishes it or schedules a retry."""
+    with app.app_context():
+        try:
+            run_ingest_stages(job, INGEST_QUEUE.checkpoint)
+        except Exception as e:
+            print(f"Ingestion job {job['id']} failed at attempt {job['attempts']}: {e}")
+            message = _ingest_error_message(e)
+            try:
+                if job['attempts'] < INGEST_MAX_ATTEMPTS and not isinstance(e, IngestRejected):
+                    INGEST_QUEUE.retry(job, message)
+                    _set_ingest_status(job['payload']['lesson_id'], 'retrying', message)
+                else:
+                    INGEST_QUEUE.finish(job, message)
+                    _discard_spooled_uploads(job['payload'])
+                    _set_ingest_status(job['payload']['lesson_id'], 'failed', message, toc=True)
+            except Exception as status_error:
+                print(f"Error recording failure of ingestion job {job['id']}: {status_error}")
+            return
+        INGEST_QUEUE.finish(job)
+
+def ingest_worker_loop(stop_when_idle=False):
+    while True:
+        try:
+            job = INGEST_QUEUE.claim()
+        except Exception as e:
+            print(f"Error claiming ingestion job: {e}")
+            job = None
+        if job:
+            process_ingest_job(job)
+            continue
+        if stop_when_idle: return
+        INGEST_WAKE.wait(INGEST_POLL_SECONDS)
+        INGEST_WAKE.clear()
+
+def ensure_ingest_worker():
+    """Starts the in-process worker thread if it isn't running; it also resumes jobs left by a restart."""
+    global ingest_worker_thread
+    if INGEST_QUEUE is None: return
+    with INGEST_WORKER_LOCK:
+        if ingest_worker_thread is None or not ingest_worker_thread.is_alive():
+            ingest_worker_thread = threading.Thread(target=ingest_worker_loop, name='ingest-worker', daemon=True)
+            ingest_worker_thread.start()
+
+def enqueue_chapter_ingest(lesson_id, title, script, editor_html, parsed=None):
+    """Queues (or, inline, runs) ingestion for a chapter form; returns the error message if an inline run failed.
+    `parsed` is a (parsed_data, llm_blocks) pair the caller already has, which skips the parse stage."""
+    payload = {'lesson_id': lesson_id, 'title': title, 'script': script, 'editor_html': editor_html, 'queued_at': time.time()}
+    if parsed: payload.update(parsed=parsed[0], llm_blocks=parsed[1])
+    uploaded = request.form.get('uploaded_media')
+    if uploaded:
+        try:
+            object_names = json.loads(uploaded)
+        except ValueError:
+            object_names = []
+        payload['uploaded_media'] = object_names if isinstance(object_names, list) else []
+    else:
+        payload['files'] = _spool_uploads(request.files.getlist('media_files'), uuid.uuid4().hex)
+    if INGEST_QUEUE is not None:
+        repo().update('lessons', lesson_id, {'ingest_job_id': INGEST_QUEUE.enqueue('chapter', payload, serial_key=lesson_id)})
+        ensure_ingest_worker()
+        INGEST_WAKE.set()
+        return None
+    # One attempt only: the request is already racing the host's function timeout, and the creator can resubmit.
+    job = {'id': uuid.uuid4().hex, 'payload': payload, 'stage': 'parse' if parsed else None}
+    try:
+        run_ingest_stages(job)
+        return None
+    except Exception as e:
+        print(f"Inline ingestion of lesson {lesson_id} failed: {e}")
+        message = _ingest_error_message(e)
+    _discard_spooled_uploads(payload)
+    _set_ingest_status(lesson_id, 'failed', message, toc=True)
+    return message
 
 # --- Main Routes ---
 @app.route('/')
@@ -199,24 +1595,22 @@ def index():
 @app.route('/explore')
 @check_db_connection
 def explore():
-    courses_query = db.collection('courses').where('status', '==', 'published').stream()
-    courses = [_doc_to_dict(c) for c in courses_query]
-    
-    creator_ids = list({c['user_id'] for c in courses if 'user_id' in c})
-    if creator_ids:
-        creators_query = db.collection('users').where(firestore.FieldPath.document_id(), 'in', creator_ids).stream()
-        creators = {cr.id: _doc_to_dict(cr) for cr in creators_query}
-        for c in courses:
-            c['creator'] = creators.get(c.get('user_id'))
+    after = request.args.get('after')
+    cursor_course = repo().get('courses', after) if after else None
+    if not cursor_course or cursor_course.get('status') != 'published' or not cursor_course.get('created_at'):
+        page = get_catalog_snapshot()
+    else:
+        query = _catalog_query(repo().client).start_after({'created_at': cursor_course['created_at'], '__name__': cursor_course['id']})
+        courses = repo().stream(query.limit(EXPLORE_PAGE_SIZE + 1))
+        page = _catalog_page(courses, repo().get_many('users', [c.get('user_id') for c in courses]))
     
-    return render_template('explore.html', courses=courses)
+    return render_template('explore.html', courses=page['courses'], next_cursor=page['next_cursor'], is_first_page=not cursor_course)
 
 @app.route('/course/<string:course_id>')
 @check_db_connection
 def course_detail_page(course_id):
-    course_doc = db.collection('courses').document(course_id).get()
-    if not course_doc.exists: abort(404)
-    course = _doc_to_dict(course_doc)
+    course = repo().get('courses', course_id)
+    if not course: abort(404)
     
     share_id = request.args.get('share_id')
     is_authorized = course['status'] == 'published' or \
@@ -224,11 +1618,10 @@ def course_detail_page(course_id):
                     (course.get('shareable_link_id') and course['shareable_link_id'] == share_id)
     if not is_authorized: abort(404)
     
-    creator_doc = db.collection('users').document(course['user_id']).get()
-    course['creator'] = _doc_to_dict(creator_doc)
-    
-    lessons_query = db.collection('lessons').where('course_id', '==', course_id).order_by('chapter_number').stream()
-    course['lessons'] = [_doc_to_dict(l) for l in lessons_query]
+    course['creator'] = repo().get('users', course['user_id'])
+    course['lessons'] = live_toc(course)
+    course['rating_histogram'] = get_rating_histogram(course)
+    rollup_course_counters(course)
     
     return render_template('course_detail.html', course=course, share_id=share_id)
 
@@ -241,15 +1634,14 @@ def register():
         username = request.form.get('username')
         password = request.form.get('password')
 
-        users_ref = db.collection('users').where('username', '==', username).limit(1).stream()
-        if len(list(users_ref)) > 0:
+        if repo().first(repo().collection('users').where('username', '==', username)):
             flash('Username already exists.', 'warning')
             return redirect(url_for('register'))
 
         try:
             email = f"{username.lower().replace(' ', '_')}@coursewell.app"
             user_record = auth.create_user(email=email, password=password, display_name=username)
-            db.collection('users').document(user_record.uid).set({'username': username, 'is_admin': False, 'created_at': firestore.SERVER_TIMESTAMP})
+            repo().set('users', user_record.uid, {'username': username, 'is_admin': False, 'created_at': firestore.SERVER_TIMESTAMP})
             flash('Account created successfully! Please log in.', 'success')
             return redirect(url_for('login'))
         except Exception as e:
@@ -305,22 +1697,13 @@ def logout():
 @login_required
 @check_db_connection
 def dashboard():
-    enrollments_query = db.collection('enrollments').where('user_id', '==', current_user.uid).stream()
-    enrollments = [_doc_to_dict(e) for e in enrollments_query]
+    enrollments = repo().stream(repo().collection('enrollments').where('user_id', '==', current_user.uid))
 
-    course_ids = [e['course_id'] for e in enrollments if 'course_id' in e]
-    if course_ids:
-        courses_query = db.collection('courses').where(firestore.FieldPath.document_id(), 'in', course_ids).stream()
-        courses = {c.id: _doc_to_dict(c) for c in courses_query}
-        
-        creator_ids = list({c['user_id'] for c in courses.values() if 'user_id' in c})
-        if creator_ids:
-            creators_query = db.collection('users').where(firestore.FieldPath.document_id(), 'in', creator_ids).stream()
-            creators = {cr.id: _doc_to_dict(cr) for cr in creators_query}
-            for c in courses.values(): c['creator'] = creators.get(c.get('user_id'))
-        
-        for e in enrollments:
-            e['course'] = courses.get(e['course_id'])
+    courses = repo().get_many('courses', [e.get('course_id') for e in enrollments])
+    creators = repo().get_many('users', [c.get('user_id') for c in courses.values()])
+    for c in courses.values(): c['creator'] = creators.get(c.get('user_id'))
+    for e in enrollments:
+        e['course'] = courses.get(e.get('course_id'))
 
     return render_template('dashboard.html', enrollments=enrollments)
 
@@ -328,8 +1711,7 @@ def dashboard():
 @login_required
 @check_db_connection
 def creator_dashboard():
-    courses_query = db.collection('courses').where('user_id', '==', current_user.uid).stream()
-    created_courses = [_doc_to_dict(c) for c in courses_query]
+    created_courses = repo().stream(repo().collection('courses').where('user_id', '==', current_user.uid))
     return render_template('creator_dashboard.html', created_courses=created_courses)
 
 @app.route('/course/create', methods=['POST'])
@@ -345,38 +1727,60 @@ def create_course():
         'title': title, 'user_id': current_user.uid, 'status': 'draft', 'is_published': False,
         'description': '', 'thumbnail_url': None, 'shareable_link_id': None, 
         'created_at': firestore.SERVER_TIMESTAMP,
-        'lesson_count': 0, 'review_count': 0, 'total_rating_sum': 0, 'average_rating': 0.0
+        'lesson_count': 0, 'review_count': 0, 'total_rating_sum': 0, 'average_rating': 0.0, 'counters_sharded': True
     }
-    _, course_ref = db.collection('courses').add(new_course_data)
+    course_id = repo().add('courses', new_course_data)
     flash('Course created! You can now manage it.', 'success')
-    return redirect(url_for('manage_course', course_id=course_ref.id))
+    return redirect(url_for('manage_course', course_id=course_id))
 
 @app.route('/course/<string:course_id>/manage')
 @login_required
 @check_db_connection
 def manage_course(course_id):
-    course_doc = db.collection('courses').document(course_id).get()
-    if not course_doc.exists or course_doc.to_dict().get('user_id') != current_user.uid: abort(403)
-    course = _doc_to_dict(course_doc)
-    lessons_query = db.collection('lessons').where('course_id', '==', course_id).order_by('chapter_number').stream()
-    course['lessons'] = [_doc_to_dict(l) for l in lessons_query]
+    course = repo().get('courses', course_id)
+    if not course or course.get('user_id') != current_user.uid: abort(403)
+    course['lessons'] = get_course_toc(course)
     return render_template('manage_course.html', course=course)
 
 @app.route('/course/<string:course_id>/add_chapter', methods=['GET'])
 @login_required
 @check_db_connection
 def add_chapter_page(course_id):
-    course_doc = db.collection('courses').document(course_id).get()
-    if not course_doc.exists or course_doc.to_dict().get('user_id') != current_user.uid: abort(403)
-    return render_template('create_chapter.html', course=_doc_to_dict(course_doc))
+    course = repo().get('courses', course_id)
+    if not course or course.get('user_id') != current_user.uid: abort(403)
+    return render_template('create_chapter.html', course=course)
+
+@app.route('/course/<string:course_id>/media/upload_urls', methods=['POST'])
+@login_required
+@check_db_connection
+def media_upload_urls(course_id):
+    course = repo().get('courses', course_id)
+    if not course or course.get('user_id') != current_user.uid: abort(403)
+    files = (request.get_json(silent=True) or {}).get('files') or []
+    if not isinstance(files, list) or not 0 < len(files) <= DIRECT_UPLOAD_MAX_FILES:
+        return jsonify({'error': 'No files to upload.'}), 400
+    uploads = []
+    for f in files:
+        f = f if isinstance(f, dict) else {}
+        filename, content_type, size = str(f.get('filename', '')), str(f.get('content_type', '')), f.get('size') or 0
+        if not allowed_file(filename) or not content_type.startswith(('image/', 'audio/')):
+            return jsonify({'error': f"{filename} is not an allowed media file."}), 400
+        if not isinstance(size, int) or size > DIRECT_UPLOAD_MAX_BYTES:
+            return jsonify({'error': f"{filename} is too large."}), 400
+        try:
+            uploads.append(sign_direct_upload(course_id, filename, content_type, size))
+        except Exception as e:
+            # Without a signing key the client falls back to posting the files with the form.
+            print(f"Error signing upload URL for {filename}: {e}")
+            return jsonify({'error': 'Direct uploads are unavailable.'}), 503
+    return jsonify({'uploads': uploads})
 
 @app.route('/course/<string:course_id>/save_chapter', methods=['POST'])
 @login_required
 @check_db_connection
 def save_chapter(course_id):
-    course_ref = db.collection('courses').document(course_id)
-    course_doc = course_ref.get()
-    if not course_doc.exists or course_doc.to_dict().get('user_id') != current_user.uid:
+    course = repo().get('courses', course_id)
+    if not course or course.get('user_id') != current_user.uid:
         abort(403)
     
     script, title = request.form.get('script', ''), request.form.get('title', '')
@@ -384,54 +1788,33 @@ def save_chapter(course_id):
         flash('Both a title and script are required.', 'warning')
         return redirect(url_for('add_chapter_page', course_id=course_id))
 
-    parsed_data = parse_lesson_script(script)
-    if not parsed_data:
-        flash('The AI could not understand the lesson structure. Please check your tags and try again.', 'danger')
-        return redirect(url_for('add_chapter_page', course_id=course_id))
-
-    uploaded_files = request.files.getlist('media_files')
-    image_urls, audio_urls = [], []
-    bucket = storage.bucket()
+    parsed = None
+    if INGEST_QUEUE is None:
+        # Inline there is no job to come back to, so a script that can't be parsed is rejected before the chapter exists.
+        parsed = parse_lesson_blocks(script)
+        if not parsed[0]:
+            flash(LESSON_PARSE_ERROR, 'danger')
+            return redirect(url_for('add_chapter_page', course_id=course_id))
 
-    for file in uploaded_files:
-        if file and file.filename != '' and allowed_file(file.filename):
-            try:
-                filename = f"course_media/{course_id}/{uuid.uuid4()}{os.path.splitext(file.filename)[1]}"
-                blob = bucket.blob(filename)
-                blob.upload_from_file(file, content_type=file.content_type)
-                blob.make_public()
-                
-                if file.content_type.startswith('image/'):
-                    image_urls.append(blob.public_url)
-                elif file.content_type.startswith('audio/'):
-                    audio_urls.append(blob.public_url)
-            except Exception as e:
-                print(f"Error uploading file {file.filename} to Firebase Storage: {e}")
-                flash(f"Error uploading {file.filename}. Please try again.", "danger")
-                return redirect(url_for('add_chapter_page', course_id=course_id))
-
-    image_iterator = iter(image_urls)
-    audio_iterator = iter(audio_urls)
-    for step in parsed_data.get('steps', []):
-        if step.get('type') == 'MEDIA':
-            if step.get('media_type') == 'image':
-                step['media_url'] = next(image_iterator, None)
-            elif step.get('media_type') == 'audio':
-                step['media_url'] = next(audio_iterator, None)
-
-    last_chapter_query = db.collection('lessons').where('course_id', '==', course_id).order_by('chapter_number', direction=firestore.Query.DESCENDING).limit(1).stream()
-    last_chapter_list = list(last_chapter_query)
-    new_chapter_number = (last_chapter_list[0].to_dict()['chapter_number'] + 1) if last_chapter_list else 1
+    toc = get_course_toc(course)
+    new_chapter_number = (toc[-1]['chapter_number'] + 1) if toc else 1
 
+    # A draft with no steps yet, hidden from students (version 0) until the job's save stage fills it in.
     new_lesson_data = {
         'title': title, 'raw_script': script, 'editor_html': request.form.get('editor_html', ''),
-        'parsed_json': json.dumps(parsed_data), 'course_id': course_id, 'chapter_number': new_chapter_number
+        'parsed_json': json.dumps({'steps': []}), 'course_id': course_id, 'chapter_number': new_chapter_number,
+        'version': 0, 'ingest_status': 'queued', 'ingest_updated_at': firestore.SERVER_TIMESTAMP
     }
-    db.collection('lessons').add(new_lesson_data)
-    
-    course_ref.update({'lesson_count': firestore.Increment(1)})
-    
-    flash('Chapter added successfully!', 'success')
+    new_lesson_id = repo().add('lessons', new_lesson_data)
+    save_toc_entry(course_id, {**toc_entry(new_lesson_id, title, new_chapter_number, {}), 'ingest_status': 'queued', 'version': 0})
+
+    error = enqueue_chapter_ingest(new_lesson_id, title, script, request.form.get('editor_html', ''), parsed)
+    if error:
+        flash(f"The chapter was saved as a draft, but it could not be processed: {error}", 'danger')
+    elif INGEST_QUEUE is not None:
+        flash('Chapter saved! It is being processed and will be ready in a moment.', 'success')
+    else:
+        flash('Chapter added successfully!', 'success')
     return redirect(url_for('manage_course', course_id=course_id))
 
 
@@ -439,92 +1822,86 @@ def save_chapter(course_id):
 @login_required
 @check_db_connection
 def update_chapter(lesson_id):
-    lesson_ref = db.collection('lessons').document(lesson_id)
-    lesson_doc = lesson_ref.get()
-    if not lesson_doc.exists: abort(404)
-    lesson = _doc_to_dict(lesson_doc)
-    
-    course_doc = db.collection('courses').document(lesson['course_id']).get()
-    if not course_doc.exists or course_doc.to_dict().get('user_id') != current_user.uid: abort(403)
+    lesson = repo().get('lessons', lesson_id)
+    if not lesson: abort(404)
     
-    old_media_map = {step.get('alt_text'): step.get('media_url') for step in json.loads(lesson.get('parsed_json', '{}')).get('steps', []) if step.get('type') == 'MEDIA' and step.get('media_url')}
+    course = repo().get('courses', lesson['course_id'])
+    if not course or course.get('user_id') != current_user.uid: abort(403)
     
     script, title = request.form.get('script', ''), request.form.get('title', '')
-    
-    parsed_data = parse_lesson_script(script)
-    if not parsed_data:
-        flash('The AI could not understand the lesson structure.', 'danger')
-        return redirect(url_for('edit_chapter_page', lesson_id=lesson_id))
 
-    uploaded_files = request.files.getlist('media_files')
-    image_urls, audio_urls = [], []
-    bucket = storage.bucket()
-    for file in uploaded_files:
-        if file and file.filename != '' and allowed_file(file.filename):
-            try:
-                filename = f"course_media/{lesson['course_id']}/{uuid.uuid4()}{os.path.splitext(file.filename)[1]}"
-                blob = bucket.blob(filename)
-                blob.upload_from_file(file, content_type=file.content_type)
-                blob.make_public()
-                if file.content_type.startswith('image/'): image_urls.append(blob.public_url)
-                elif file.content_type.startswith('audio/'): audio_urls.append(blob.public_url)
-            except Exception as e:
-                print(f"Error uploading file {file.filename} to Firebase Storage: {e}")
-                flash(f"Error uploading {file.filename}. Please try again.", "danger")
-                return redirect(url_for('edit_chapter_page', lesson_id=lesson_id))
-
-    image_iterator = iter(image_urls)
-    audio_iterator = iter(audio_urls)
-    for step in parsed_data.get('steps', []):
-        if step.get('type') == 'MEDIA':
-            alt_text = step.get('alt_text')
-            assigned_url = old_media_map.get(alt_text) 
-            
-            if step.get('media_type') == 'image':
-                assigned_url = next(image_iterator, assigned_url)
-            elif step.get('media_type') == 'audio':
-                assigned_url = next(audio_iterator, assigned_url)
-            
-            step['media_url'] = assigned_url
-
-    lesson_ref.update({
-        'title': title, 'raw_script': script, 'editor_html': request.form.get('editor_html', ''),
-        'parsed_json': json.dumps(parsed_data)
-    })
-    
-    flash('Chapter updated successfully!', 'success')
+    # Students keep the current version until the job's save stage replaces it.
+    _set_ingest_status(lesson_id, 'queued', toc=True)
+    error = enqueue_chapter_ingest(lesson_id, title, script, request.form.get('editor_html', ''))
+    if error:
+        flash(f"The chapter could not be updated: {error}", 'danger')
+        return redirect(url_for('edit_chapter_page', lesson_id=lesson_id))
+    flash('Chapter saved! It is being processed and will be ready in a moment.' if INGEST_QUEUE is not None else 'Chapter updated successfully!', 'success')
     return redirect(url_for('manage_course', course_id=lesson['course_id']))
 
+@app.route('/chapter/<string:lesson_id>/ingest_status', methods=['GET'])
+@login_required
+@check_db_connection
+def chapter_ingest_status(lesson_id):
+    lesson = repo().get('lessons', lesson_id)
+    if not lesson: abort(404)
+    course = repo().get('courses', lesson['course_id'])
+    if not course or course.get('user_id') != current_user.uid: abort(403)
+    ensure_ingest_worker()
+    status = {'status': lesson.get('ingest_status', 'ready'), 'error': lesson.get('ingest_error')}
+    if INGEST_QUEUE is None and status['status'] not in ('ready', 'failed'):
+        # Nothing resumes an inline run whose function was killed, so a status that stopped moving is reported as failed.
+        updated_at = lesson.get('ingest_updated_at')
+        if not updated_at or (datetime.datetime.now(datetime.timezone.utc) - updated_at).total_seconds() > INGEST_INLINE_TIMEOUT_SECONDS:
+            status = {'status': 'failed', 'error': 'Processing this chapter timed out. Please save it again.'}
+            _set_ingest_status(lesson_id, status['status'], status['error'], toc=True)
+    job = INGEST_QUEUE.get(lesson['ingest_job_id']) if INGEST_QUEUE is not None and lesson.get('ingest_job_id') else None
+    if job: status['attempts'] = job['attempts']
+    return jsonify(status)
+
 @app.route('/chapter/<string:lesson_id>/delete', methods=['POST'])
 @login_required
 @check_db_connection
 def delete_chapter(lesson_id):
-    lesson_ref = db.collection('lessons').document(lesson_id)
-    lesson_doc = lesson_ref.get()
-    if not lesson_doc.exists: abort(404)
-    lesson = _doc_to_dict(lesson_doc)
+    lesson = repo().get('lessons', lesson_id)
+    if not lesson: abort(404)
     course_id = lesson['course_id']
-    course_ref = db.collection('courses').document(course_id)
-    course_doc = course_ref.get()
-    if not course_doc.exists or course_doc.to_dict().get('user_id') != current_user.uid: abort(403)
+    course = repo().get('courses', course_id)
+    if not course or course.get('user_id') != current_user.uid: abort(403)
+    get_course_toc(course)
+    lesson_ref, course_ref = repo().ref('lessons', lesson_id), repo().ref('courses', course_id)
+    reordered_paths = []
 
     @firestore.transactional
     def delete_and_reorder_transaction(transaction):
         lesson_snapshot = lesson_ref.get(transaction=transaction)
         if not lesson_snapshot.exists: return
         deleted_chapter_number = lesson_snapshot.to_dict()['chapter_number']
+        course_toc = (course_ref.get(transaction=transaction).to_dict() or {}).get('toc', [])
+        # Transactions must finish all reads before the first write.
+        chapters_to_reorder = list(repo().collection('lessons').where('course_id', '==', course_id).where('chapter_number', '>', deleted_chapter_number).stream(transaction=transaction))
         
         transaction.delete(lesson_ref)
         
-        chapters_to_reorder_query = db.collection('lessons').where('course_id', '==', course_id).where('chapter_number', '>', deleted_chapter_number).stream()
-        for chapter in chapters_to_reorder_query:
+        for chapter in chapters_to_reorder:
             new_num = chapter.to_dict()['chapter_number'] - 1
             transaction.update(chapter.reference, {'chapter_number': new_num})
+            reordered_paths.append(chapter.reference.path)
         
-        transaction.update(course_ref, {'lesson_count': firestore.Increment(-1)})
-
-    transaction = db.transaction()
+        toc = []
+        for entry in course_toc:
+            if entry['id'] == lesson_id: continue
+            if entry['chapter_number'] > deleted_chapter_number:
+                entry = {**entry, 'chapter_number': entry['chapter_number'] - 1}
+            toc.append(entry)
+        transaction.update(course_ref, {'lesson_count': sum(1 for e in toc if chapter_is_live(e)), 'toc': toc})
+
+    transaction = repo().client.transaction()
     delete_and_reorder_transaction(transaction)
+    repo().record_transaction(reads=2 + max(len(reordered_paths), 1), writes=2 + len(reordered_paths),
+                              paths=[lesson_ref.path, course_ref.path] + reordered_paths)
+    invalidate_rag_retriever(lesson_id)
+    BACKGROUND_EXECUTOR.submit(invalidate_tutor_responses, lesson_id)
     
     flash('Chapter deleted successfully.', 'success')
     return redirect(url_for('manage_course', course_id=course_id))
@@ -533,9 +1910,8 @@ def delete_chapter(lesson_id):
 @login_required
 @check_db_connection
 def enroll_in_course(course_id):
-    course_doc = db.collection('courses').document(course_id).get()
-    if not course_doc.exists: abort(404)
-    course = _doc_to_dict(course_doc)
+    course = repo().get('courses', course_id)
+    if not course: abort(404)
 
     if current_user.uid == course['user_id']:
         flash("You cannot enroll in a course you've created.", "warning")
@@ -545,11 +1921,88 @@ def enroll_in_course(course_id):
         return redirect(url_for('course_player', course_id=course_id))
         
     new_enrollment = {'user_id': current_user.uid, 'course_id': course_id, 'last_completed_chapter_number': 0, 'completed_at': None}
-    db.collection('enrollments').add(new_enrollment)
+    try:
+        repo().create('enrollments', enrollment_id_for(current_user.uid, course_id), new_enrollment)
+    except AlreadyExists:
+        flash("You are already enrolled in this course.", "info")
+        return redirect(url_for('course_player', course_id=course_id))
+    remember_enrollment(current_user.uid, course_id)
     
     flash(f"You have successfully enrolled in '{course['title']}'!", 'success')
     return redirect(url_for('course_player', course_id=course_id))
 
+REVIEWS_PAGE_SIZE = 20
+RATING_LEVELS = range(1, 6)
+
+def get_rating_histogram(course):
+    """Star counts keyed '1'..'5', kept on the course by submit_review; older courses are counted once."""
+    if 'rating_histogram' not in course:
+        histogram = {str(level): 0 for level in RATING_LEVELS}
+        if course.get('review_count'):
+            for level in RATING_LEVELS:
+                query = repo().collection('reviews').where('course_id', '==', course['id']).where('rating', '==', level)
+                histogram[str(level)] = query.count().get()[0][0].value
+            repo().record_transaction(reads=len(RATING_LEVELS))
+        repo().update('courses', course['id'], {'rating_histogram': histogram})
+        course['rating_histogram'] = histogram
+    return course['rating_histogram']
+
+# Review totals are written to one of COUNTER_SHARDS counter documents under the course, so a burst of
+# reviews never queues behind Firestore's one-write-per-second-per-document limit. The course keeps a
+# rolled-up copy (review_count, total_rating_sum, average_rating, rating_histogram) for cheap display,
+# refreshed from the shards on read at most every COUNTER_ROLLUP_SECONDS.
+COUNTER_SHARDS = int(os.getenv("COUNTER_SHARDS", 10))
+COUNTER_ROLLUP_SECONDS = int(os.getenv("COUNTER_ROLLUP_SECONDS", 60))
+
+def _counter_shards(course_id):
+    return f"courses/{course_id}/counter_shards"
+
+def ensure_counter_shards(course):
+    """Moves totals kept on older course documents into a 'base' shard, once."""
+    if course.get('counters_sharded'): return
+    histogram = get_rating_histogram(course)
+    course_ref, base_ref = repo().ref('courses', course['id']), repo().ref(_counter_shards(course['id']), 'base')
+
+    @firestore.transactional
+    def seed_base_shard(transaction):
+        current = course_ref.get(transaction=transaction).to_dict() or {}
+        if current.get('counters_sharded'): return
+        transaction.set(base_ref, {
+            'review_count': current.get('review_count', 0), 'total_rating_sum': current.get('total_rating_sum', 0),
+            'rating_histogram': current.get('rating_histogram') or histogram
+        })
+        transaction.update(course_ref, {'counters_sharded': True})
+
+    seed_base_shard(repo().client.transaction())
+    repo().record_transaction(reads=1, writes=2, paths=[course_ref.path, base_ref.path])
+    course['counters_sharded'] = True
+
+def sum_counter_shards(course_id):
+    totals = {'review_count': 0, 'total_rating_sum': 0, 'rating_histogram': {str(level): 0 for level in RATING_LEVELS}}
+    for shard in repo().stream(repo().collection(_counter_shards(course_id)), remember=False):
+        totals['review_count'] += shard.get('review_count', 0)
+        totals['total_rating_sum'] += shard.get('total_rating_sum', 0)
+        for level, count in (shard.get('rating_histogram') or {}).items():
+            totals['rating_histogram'][level] = totals['rating_histogram'].get(level, 0) + count
+    totals['average_rating'] = totals['total_rating_sum'] / totals['review_count'] if totals['review_count'] else 0.0
+    return totals
+
+def rollup_course_counters(course, exact=False):
+    """Refreshes the course's display totals from its shards when they are stale (or always, if exact)."""
+    if not course.get('counters_sharded'): return course
+    now = datetime.datetime.now(datetime.timezone.utc)
+    rolled_up_at = course.get('counters_rolled_up_at')
+    stale = not rolled_up_at or (now - rolled_up_at).total_seconds() >= COUNTER_ROLLUP_SECONDS
+    if not (stale or exact): return course
+    totals = sum_counter_shards(course['id'])
+    if stale:
+        changed = any(course.get(field) != value for field, value in totals.items())
+        repo().update('courses', course['id'], {**totals, 'counters_rolled_up_at': now})
+        course['counters_rolled_up_at'] = now
+        if changed and course.get('status') == 'published': catalog_changed()
+    course.update(totals)
+    return course
+
 @app.route('/course/<string:course_id>/review', methods=['POST'])
 @login_required
 @check_db_connection
@@ -561,36 +2014,26 @@ def submit_review(course_id):
         return redirect(url_for('certificate_view', course_id=course_id))
     
     rating = int(rating_str)
-    course_ref = db.collection('courses').document(course_id)
-    new_review_ref = db.collection('reviews').document()
+    if rating not in RATING_LEVELS:
+        flash("Ratings run from 1 to 5 stars.", "warning")
+        return redirect(url_for('certificate_view', course_id=course_id))
+    course = repo().get('courses', course_id)
+    if not course: abort(404)
     new_review_data = {
         'rating': rating, 'comment': comment, 'course_id': course_id, 
         'user_id': current_user.uid, 'created_at': firestore.SERVER_TIMESTAMP
     }
 
-    @firestore.transactional
-    def _update_course_review_stats(transaction):
-        course_snapshot = course_ref.get(transaction=transaction)
-        if not course_snapshot.exists:
-            raise Exception("Course not found!")
-        
-        current_sum = course_snapshot.get('total_rating_sum') or 0
-        current_count = course_snapshot.get('review_count') or 0
-
-        new_sum = current_sum + rating
-        new_count = current_count + 1
-        new_average = new_sum / new_count if new_count > 0 else 0
-
-        transaction.set(new_review_ref, new_review_data)
-        transaction.update(course_ref, {
-            'total_rating_sum': new_sum,
-            'review_count': new_count,
-            'average_rating': new_average
-        })
-
     try:
-        transaction = db.transaction()
-        _update_course_review_stats(transaction)
+        ensure_counter_shards(course)
+        # The review and its shard increment land together; the course document itself is not written.
+        batch = repo().batch()
+        batch.set('reviews', repo().new_id('reviews'), new_review_data)
+        batch.set(_counter_shards(course_id), str(random.randrange(COUNTER_SHARDS)), {
+            'review_count': firestore.Increment(1), 'total_rating_sum': firestore.Increment(rating),
+            'rating_histogram': {str(rating): firestore.Increment(1)}
+        }, merge=True)
+        batch.commit()
         flash("Thank you for your feedback!", "success")
     except Exception as e:
         flash(f"An error occurred while submitting your review: {e}", "danger")
@@ -600,46 +2043,48 @@ def submit_review(course_id):
 @app.route('/course/<string:course_id>/reviews')
 @check_db_connection
 def reviews_page(course_id):
-    course_doc = db.collection('courses').document(course_id).get();
-    if not course_doc.exists: abort(404)
-    course = _doc_to_dict(course_doc)
-    reviews_query = db.collection('reviews').where('course_id', '==', course_id).order_by('created_at', direction=firestore.Query.DESCENDING).stream()
-    reviews = [_doc_to_dict(r) for r in reviews_query]
-
-    user_ids = {r['user_id'] for r in reviews}
-    if user_ids:
-        users_query = db.collection('users').where(firestore.FieldPath.document_id(), 'in', list(user_ids)).stream()
-        users = {u.id: _doc_to_dict(u) for u in users_query}
-        for r in reviews: r['user'] = users.get(r['user_id'])
+    course = repo().get('courses', course_id)
+    if not course: abort(404)
+    course['rating_histogram'] = get_rating_histogram(course)
+    rollup_course_counters(course, exact=True)
+
+    query = repo().collection('reviews').where('course_id', '==', course_id) \
+        .order_by('created_at', direction=firestore.Query.DESCENDING).order_by('__name__', direction=firestore.Query.DESCENDING)
+    after = request.args.get('after')
+    cursor_review = repo().get('reviews', after) if after else None
+    if cursor_review and cursor_review.get('course_id') == course_id:
+        query = query.start_after({'created_at': cursor_review['created_at'], '__name__': cursor_review['id']})
+    else:
+        cursor_review = None
+    reviews = repo().stream(query.limit(REVIEWS_PAGE_SIZE + 1))
+    next_cursor = reviews[REVIEWS_PAGE_SIZE - 1]['id'] if len(reviews) > REVIEWS_PAGE_SIZE else None
+    reviews = reviews[:REVIEWS_PAGE_SIZE]
+
+    users = repo().get_many('users', [r.get('user_id') for r in reviews])
+    for r in reviews: r['user'] = users.get(r.get('user_id'))
     
-    return render_template('reviews.html', course=course, reviews=reviews)
+    return render_template('reviews.html', course=course, reviews=reviews, next_cursor=next_cursor, is_first_page=not cursor_review)
 
 @app.route('/course/<string:course_id>/player')
 @login_required
 @check_db_connection
 def course_player(course_id):
-    enrollment_query = db.collection('enrollments').where('user_id', '==', current_user.uid).where('course_id', '==', course_id).limit(1).stream()
-    enrollment_list = list(enrollment_query)
-    enrollment = _doc_to_dict(enrollment_list[0]) if enrollment_list else None
+    enrollment = repo().find_enrollment(current_user.uid, course_id)
 
     chapter_to_start = (enrollment['last_completed_chapter_number'] + 1) if enrollment else 1
     
-    lessons_query = db.collection('lessons').where('course_id', '==', course_id).order_by('chapter_number').limit(int(chapter_to_start)).stream()
-    lessons = [_doc_to_dict(l) for l in lessons_query]
+    course = repo().get('courses', course_id)
+    if not course: abort(404)
+    lessons = live_toc(course)
     
-    course_doc = db.collection('courses').document(course_id).get()
     if not lessons:
-        if current_user.is_authenticated and current_user.uid == course_doc.to_dict().get('user_id'):
+        if current_user.is_authenticated and current_user.uid == course.get('user_id'):
             flash('This course has no chapters yet. Add one to enable the preview.', 'info')
             return redirect(url_for('manage_course', course_id=course_id))
         flash("This course has no content yet.", "warning")
         return redirect(url_for('explore'))
         
-    target_lesson = lessons[-1] if lessons else None
-    
-    if not target_lesson:
-        flash("Could not find a valid chapter to start.", "warning")
-        return redirect(url_for('dashboard'))
+    target_lesson = next((l for l in lessons if l['chapter_number'] >= chapter_to_start), lessons[-1])
 
     return redirect(url_for('student_chapter_view', course_id=course_id, chapter_number=target_lesson['chapter_number']))
 
@@ -647,30 +2092,25 @@ def course_player(course_id):
 @login_required
 @check_db_connection
 def student_chapter_view(course_id, chapter_number):
-    course_doc = db.collection('courses').document(course_id).get()
-    if not course_doc.exists: abort(404)
-    course = _doc_to_dict(course_doc)
+    course = repo().get('courses', course_id)
+    if not course: abort(404)
     
-    lesson_query = db.collection('lessons').where('course_id', '==', course_id).where('chapter_number', '==', chapter_number).limit(1).stream()
-    lesson_list = list(lesson_query)
-    if not lesson_list: abort(404)
-    lesson = _doc_to_dict(lesson_list[0])
+    course['lessons'] = live_toc(course)
+    chapter = toc_lookup(course['lessons'], chapter_number)
+    if not chapter: abort(404)
+    # The lesson and the deterministic enrollment id are independent, so both come back in one round trip.
+    lesson, _ = repo().get_all(('lessons', chapter['id']), ('enrollments', enrollment_id_for(current_user.uid, course_id)))
+    if not lesson: abort(404)
     
-    enrollment_query = db.collection('enrollments').where('user_id', '==', current_user.uid).where('course_id', '==', course_id).limit(1).stream()
-    enrollment_list = list(enrollment_query)
-    enrollment = _doc_to_dict(enrollment_list[0]) if enrollment_list else None
+    enrollment = repo().find_enrollment(current_user.uid, course_id)
     
     is_authorized = course['status'] == 'published' or (current_user.is_authenticated and (current_user.uid == course['user_id'] or enrollment or current_user.is_admin))
     if not is_authorized: abort(404)
 
-    all_lessons_query = db.collection('lessons').where('course_id', '==', course_id).order_by('chapter_number').stream()
-    course['lessons'] = [_doc_to_dict(l) for l in all_lessons_query]
-
     initial_history_data = None
     if enrollment:
-        history_query = db.collection('chat_histories').where('enrollment_id', '==', enrollment['id']).where('lesson_id', '==', lesson['id']).limit(1).stream()
-        history_list = list(history_query)
-        if history_list: initial_history_data = _doc_to_dict(history_list[0])
+        history_record = migrate_legacy_history(repo().find_chat_history(enrollment['id'], lesson['id']))
+        if history_record: initial_history_data = chat_history_page(history_record)
     else: 
         session_key = f'preview_chat_{lesson["id"]}'
         if session_key in session: del session[session_key]
@@ -681,21 +2121,16 @@ def student_chapter_view(course_id, chapter_number):
 @login_required
 @check_db_connection
 def certificate_view(course_id):
-    enrollment_query = db.collection('enrollments').where('user_id', '==', current_user.uid).where('course_id', '==', course_id).limit(1).stream()
-    enrollment_list = list(enrollment_query)
-    if not enrollment_list: abort(404)
-    enrollment = _doc_to_dict(enrollment_list[0])
+    enrollment = repo().find_enrollment(current_user.uid, course_id)
+    if not enrollment: abort(404)
     
     if not enrollment.get('completed_at'):
         flash("You have not completed this course yet.", "warning")
         return redirect(url_for('course_player', course_id=course_id))
     
-    enrollment['user'] = _doc_to_dict(db.collection('users').document(enrollment['user_id']).get())
-    enrollment['course'] = _doc_to_dict(db.collection('courses').document(enrollment['course_id']).get())
+    enrollment['user'], enrollment['course'] = repo().get_all(('users', enrollment['user_id']), ('courses', enrollment['course_id']))
 
-    review_query = db.collection('reviews').where('user_id', '==', current_user.uid).where('course_id', '==', course_id).limit(1).stream()
-    review_list = list(review_query)
-    existing_review = _doc_to_dict(review_list[0]) if review_list else None
+    existing_review = repo().first(repo().collection('reviews').where('user_id', '==', current_user.uid).where('course_id', '==', course_id))
 
     return render_template('certificate.html', enrollment=enrollment, existing_review=existing_review)
 
@@ -703,29 +2138,25 @@ def certificate_view(course_id):
 @login_required
 @check_db_connection
 def update_course_details(course_id):
-    course_ref = db.collection('courses').document(course_id)
-    course_doc = course_ref.get()
-    if not course_doc.exists or course_doc.to_dict().get('user_id') != current_user.uid: abort(403)
+    course = repo().get('courses', course_id)
+    if not course or course.get('user_id') != current_user.uid: abort(403)
     
     update_data = {'description': request.form.get('description')}
     if 'thumbnail' in request.files:
         file = request.files['thumbnail']
         if file and file.filename != '':
             try:
-                bucket = storage.bucket()
-                filename = f"course_thumbnails/{course_id}/{uuid.uuid4()}{os.path.splitext(file.filename)[1]}"
-                blob = bucket.blob(filename)
-                blob.upload_from_file(file, content_type=file.content_type)
-                blob.make_public()
-                update_data['thumbnail_url'] = blob.public_url
+                update_data['thumbnail_url'] = store_media_file(file, f"course_thumbnails/{course_id}")
             except Exception as e:
                 print(f"Error uploading to Firebase Storage: {e}")
                 flash("There was an error uploading the thumbnail. Please try again.", "danger")
                 return redirect(url_for('manage_course', course_id=course_id))
+            update_data['thumbnail_variants'] = image_variants_for([update_data['thumbnail_url']]).get(update_data['thumbnail_url'], [])
 
     if update_data:
-        if ('description' in update_data and update_data['description'] != course_doc.to_dict().get('description')) or 'thumbnail_url' in update_data:
-             course_ref.update(update_data)
+        if ('description' in update_data and update_data['description'] != course.get('description')) or 'thumbnail_url' in update_data:
+             repo().update('courses', course_id, update_data)
+             if course.get('status') == 'published': catalog_changed()
              flash('Course details updated successfully!', 'success')
         else:
              flash('No changes were detected.', 'info')
@@ -736,22 +2167,21 @@ def update_course_details(course_id):
 @login_required
 @check_db_connection
 def edit_chapter_page(lesson_id):
-    lesson_doc = db.collection('lessons').document(lesson_id).get()
-    if not lesson_doc.exists: abort(404)
-    lesson = _doc_to_dict(lesson_doc)
-    course_doc = db.collection('courses').document(lesson['course_id']).get()
-    if not course_doc.exists or course_doc.to_dict().get('user_id') != current_user.uid: abort(403)
-    lesson['course'] = _doc_to_dict(course_doc)
+    lesson = repo().get('lessons', lesson_id)
+    if not lesson: abort(404)
+    course = repo().get('courses', lesson['course_id'])
+    if not course or course.get('user_id') != current_user.uid: abort(403)
+    lesson['course'] = course
     return render_template('edit_chapter.html', lesson=lesson)
 
 @app.route('/course/<string:course_id>/submit_for_review', methods=['POST'])
 @login_required
 @check_db_connection
 def submit_for_review(course_id):
-    course_ref = db.collection('courses').document(course_id)
-    course_doc = course_ref.get()
-    if course_doc.exists and course_doc.to_dict().get('user_id') == current_user.uid:
-        course_ref.update({'status': 'pending_review'})
+    course = repo().get('courses', course_id)
+    if course and course.get('user_id') == current_user.uid:
+        repo().update('courses', course_id, {'status': 'pending_review'})
+        if course.get('status') == 'published': catalog_changed()
         flash('Course submitted for review!', 'success')
     return redirect(url_for('manage_course', course_id=course_id))
 
@@ -760,10 +2190,10 @@ def submit_for_review(course_id):
 @login_required
 @check_db_connection
 def unpublish_course(course_id):
-    course_ref = db.collection('courses').document(course_id)
-    course_doc = course_ref.get()
-    if course_doc.exists and (course_doc.to_dict().get('user_id') == current_user.uid or (current_user.is_authenticated and current_user.is_admin)):
-        course_ref.update({'status': 'draft'})
+    course = repo().get('courses', course_id)
+    if course and (course.get('user_id') == current_user.uid or (current_user.is_authenticated and current_user.is_admin)):
+        repo().update('courses', course_id, {'status': 'draft'})
+        catalog_changed()
         flash('Course returned to draft status.', 'info')
     return redirect(url_for('manage_course', course_id=course_id))
 
@@ -772,15 +2202,11 @@ def unpublish_course(course_id):
 @admin_required
 @check_db_connection
 def admin_dashboard():
-    pending_courses_query = db.collection('courses').where('status', '==', 'pending_review').stream()
-    pending_courses = [_doc_to_dict(c) for c in pending_courses_query]
+    pending_courses = repo().stream(repo().collection('courses').where('status', '==', 'pending_review'))
     
-    creator_ids = list({c['user_id'] for c in pending_courses if 'user_id' in c})
-    if creator_ids:
-        creators_query = db.collection('users').where(firestore.FieldPath.document_id(), 'in', creator_ids).stream()
-        creators = {cr.id: _doc_to_dict(cr) for cr in creators_query}
-        for course in pending_courses:
-            course['creator'] = creators.get(course['user_id'])
+    creators = repo().get_many('users', [c.get('user_id') for c in pending_courses])
+    for course in pending_courses:
+        course['creator'] = creators.get(course.get('user_id'))
             
     return render_template('admin_dashboard.html', pending_courses=pending_courses)
 
@@ -789,41 +2215,136 @@ def admin_dashboard():
 @admin_required
 @check_db_connection
 def decide_course(course_id):
-    course_ref = db.collection('courses').document(course_id)
-    course_doc = course_ref.get()
-    if not course_doc.exists: abort(404)
+    if not repo().get('courses', course_id): abort(404)
     decision = request.form.get('decision')
     
     if decision == 'approve':
-        course_ref.update({'status': 'published'})
+        if os.getenv("GEMINI_API_KEY"):
+            lessons = [l for l in repo().course_lessons(course_id) if chapter_is_live(l)]
+            unindexed = []
+            for lesson in lessons:
+                if lesson_index_is_current(lesson['id'], lesson.get('raw_script')): continue
+                if not _get_or_create_rag_retriever(lesson['id'], lesson.get('raw_script')):
+                    unindexed.append(lesson.get('title') or lesson['id'])
+            if unindexed:
+                flash(f"Could not build the Q&A index for: {', '.join(unindexed)}. Please try approving again.", 'danger')
+                return redirect(url_for('admin_dashboard'))
+            for lesson in lessons:
+                BACKGROUND_EXECUTOR.submit(prewarm_tutor_responses, lesson)
+        repo().update('courses', course_id, {'status': 'published'})
+        catalog_changed()
         flash('Course approved and published.', 'success')
     elif decision == 'reject':
-        course_ref.update({'status': 'rejected'})
+        repo().update('courses', course_id, {'status': 'rejected'})
         flash('Course rejected and returned to creator.', 'warning')
         
     return redirect(url_for('admin_dashboard'))
 
+@app.route('/admin/metrics')
+@login_required
+@admin_required
+def admin_metrics():
+    with METRICS_LOCK:
+        metrics = dict(METRICS)
+    classified = metrics.get('intent_local', 0) + metrics.get('intent_llm', 0)
+    metrics['intent_local_match_rate'] = metrics.get('intent_local', 0) / classified if classified else None
+    for cache in ('user_cache', 'enrollment_cache'):
+        lookups = metrics.get(f'{cache}_hit', 0) + metrics.get(f'{cache}_miss', 0)
+        metrics[f'{cache}_hit_rate'] = metrics.get(f'{cache}_hit', 0) / lookups if lookups else None
+    return jsonify(metrics)
+
 @app.route('/course/<string:course_id>/generate_link', methods=['POST'])
 @login_required
 @check_db_connection
 def generate_share_link(course_id):
-    course_ref = db.collection('courses').document(course_id)
-    course_doc = course_ref.get()
-    if course_doc.exists and course_doc.to_dict().get('user_id') == current_user.uid:
-        if not course_doc.to_dict().get('shareable_link_id'):
-            course_ref.update({'shareable_link_id': str(uuid.uuid4())})
+    course = repo().get('courses', course_id)
+    if course and course.get('user_id') == current_user.uid:
+        if not course.get('shareable_link_id'):
+            repo().update('courses', course_id, {'shareable_link_id': str(uuid.uuid4())})
     return redirect(url_for('manage_course', course_id=course_id))
 
 @app.route('/share/<string:link_id>')
 @check_db_connection
 def shared_course_view(link_id):
-    course_query = db.collection('courses').where('shareable_link_id', '==', link_id).limit(1).stream()
-    course_list = list(course_query)
-    if not course_list: abort(404)
-    course = _doc_to_dict(course_list[0])
+    course = repo().first(repo().collection('courses').where('shareable_link_id', '==', link_id))
+    if not course: abort(404)
     return redirect(url_for('course_detail_page', course_id=course['id'], share_id=link_id))
     
+# --- Chat History ---
+# Each chat_histories document is a small state record (resume position, turn_count, first_seq).
+# The messages themselves live in an append-only `turns` subcollection, one document per message,
+# keyed by a zero-padded sequence number. A turn writes only its new messages.
+CHAT_PAGE_SIZE = 50
+
+def _turns_collection(history_id):
+    return f"chat_histories/{history_id}/turns"
+
+def migrate_legacy_history(history):
+    """Moves a pre-turns `history_json` blob into the turns subcollection, once."""
+    if not history or 'history_json' not in history: return history
+    log = json.loads(history.get('history_json') or '[]')
+    for start in range(0, len(log), 400):
+        batch = repo().batch()
+        for seq, entry in enumerate(log[start:start + 400], start):
+            batch.set(_turns_collection(history['id']), f"{seq:08d}", {**entry, 'seq': seq})
+        batch.commit()
+    state = {'turn_count': len(log), 'first_seq': 0}
+    repo().update('chat_histories', history['id'], {**state, 'history_json': firestore.DELETE_FIELD})
+    history = {k: v for k, v in history.items() if k != 'history_json'}
+    history.update(state)
+    return history
+
+def append_chat_turns(batch, history_id, first_seq, entries):
+    # create() rather than set(): if two requests race for the same seq, the later commit fails whole.
+    for seq, entry in enumerate(entries, first_seq):
+        batch.create(_turns_collection(history_id), f"{seq:08d}", {**entry, 'seq': seq})
+
+def load_chat_turns(history, before=None, limit=CHAT_PAGE_SIZE):
+    """Returns (turns, start_seq) for the page of turns ending just before `before` (default: the newest)."""
+    first_seq = history.get('first_seq', 0)
+    end = min(before, history.get('turn_count', 0)) if before is not None else history.get('turn_count', 0)
+    start = max(first_seq, end - limit)
+    if start >= end: return [], start
+    query = repo().collection(_turns_collection(history['id'])).where('seq', '>=', start).where('seq', '<', end).order_by('seq')
+    return repo().stream(query, remember=False), start
+
+def chat_history_page(history, before=None):
+    turns, start = load_chat_turns(history, before)
+    return {'turns': turns, 'before': start, 'has_more': start > history.get('first_seq', 0)}
+
+def purge_chat_turns(history_id, below_seq):
+    """Deletes turns hidden by a reset. Runs in the background, outside any request."""
+    try:
+        stale = db.collection(_turns_collection(history_id)).where('seq', '<', below_seq).stream()
+        batch, pending = db.batch(), 0
+        for snapshot in stale:
+            batch.delete(snapshot.reference)
+            pending += 1
+            if pending == 400:
+                batch.commit()
+                batch, pending = db.batch(), 0
+        if pending: batch.commit()
+    except Exception as e:
+        print(f"Error purging chat turns for history {history_id}: {e}")
+
 # --- Chat Routes ---
+def _stream_chat_reply(prompt, response_data, chat_log, on_complete):
+    """Streams the tutor reply as JSON lines, then persists the turn once via on_complete(log, text, finished)."""
+    def generate():
+        parts, finished = [], False
+        try:
+            for delta in stream_tutor_response(prompt):
+                parts.append(delta)
+                yield json.dumps({'delta': delta}) + '\n'
+            finished = True
+        finally:
+            # A client that disconnects is closed at a yield; its turn is still kept, with the text sent so far.
+            tutor_text = ''.join(parts)
+            if tutor_text: chat_log.append({"sender": "tutor", "type": "text", "content": tutor_text})
+            on_complete(chat_log, tutor_text, finished)
+        yield json.dumps({**response_data, 'tutor_text': tutor_text, 'done': True}) + '\n'
+    return Response(stream_with_context(generate()), mimetype='application/x-ndjson', headers={'X-Accel-Buffering': 'no'})
+
 @app.route('/chat/intent', methods=['POST'])
 @login_required
 @check_db_connection
@@ -832,183 +2353,195 @@ def classify_intent():
     user_input = data.get('user_input')
     lesson_id = data.get('lesson_id')
 
-    lesson_doc = db.collection('lessons').document(lesson_id).get()
-    if not lesson_doc.exists: abort(404)
-    lesson = _doc_to_dict(lesson_doc)
+    lesson, course, compiled, enrollment = _load_chat_lesson(lesson_id)
+    return jsonify(classify_question_intent(user_input, compiled.media_descriptions, lesson['id']))
 
-    lesson_steps = json.loads(lesson['parsed_json']).get('steps', [])
-    media_descriptions = [step.get('alt_text') for step in lesson_steps if step.get('type') == 'MEDIA' and step.get('alt_text')]
-    prompt = INTENT_CLASSIFIER_PROMPT.format(user_input, media_descriptions, user_input)
-    
-    try:
-        model = genai.GenerativeModel('gemini-1.5-pro-latest')
-        response = model.generate_content(prompt)
-        cleaned_response = response.text.strip().replace("```json", "").replace("```", "").strip()
-        intent_data = json.loads(cleaned_response)
-        return jsonify(intent_data)
-    except Exception as e:
-        print(f"Error classifying intent: {e}")
-        return jsonify({"intent": "QNA", "query": user_input})
+def _load_chat_lesson(lesson_id):
+    """Loads what every chat turn needs once: the lesson, its course, the compiled lesson and the
+    student's enrollment (None for the course creator or an admin previewing). Anyone else gets a 403
+    before any model call is made for them."""
+    lesson = repo().get('lessons', lesson_id)
+    if not lesson or not chapter_is_live(lesson): abort(404)
+    course = repo().get('courses', lesson['course_id'])
+    enrollment = repo().find_enrollment(current_user.uid, course['id'])
+    if not enrollment and current_user.uid != course['user_id'] and not current_user.is_admin: abort(403)
+    return lesson, course, compiled_lesson(lesson), enrollment
 
 @app.route('/chat', methods=['POST'])
 @login_required
 @check_db_connection
 def chat():
     data = request.json
-    lesson_id = data.get('lesson_id')
-    user_input = data.get('user_input')
-    request_type = data.get('request_type', 'LESSON_FLOW')
+    lesson, course, compiled, enrollment = _load_chat_lesson(data.get('lesson_id'))
+    return _run_chat_turn(lesson, course, compiled, enrollment, data.get('user_input'), data.get('request_type', 'LESSON_FLOW'),
+                          bool(data.get('stream')))
 
-    lesson_doc = db.collection('lessons').document(lesson_id).get()
-    if not lesson_doc.exists: abort(404)
-    lesson = _doc_to_dict(lesson_doc)
-    
-    course_doc = db.collection('courses').document(lesson['course_id']).get()
-    course = _doc_to_dict(course_doc)
-    
-    lessons_query = db.collection('lessons').where('course_id', '==', course['id']).order_by('chapter_number').stream()
-    course['lessons'] = [_doc_to_dict(l) for l in lessons_query]
-
-    lesson_steps = json.loads(lesson.get('parsed_json', '{}')).get('steps', [])
-
-    if request_type == 'MEDIA_REQUEST':
-        requested_alt_text = user_input
-        media_to_show = next((step for step in lesson_steps if step.get('type') == 'MEDIA' and step.get('alt_text') == requested_alt_text), None)
-        if media_to_show:
-            return jsonify({
-                "tutor_text": f"Of course, here is '{media_to_show.get('alt_text')}' again.",
-                "media_url": media_to_show.get('media_url'), "media_type": media_to_show.get('media_type'),
-                "alt_text": media_to_show.get('alt_text'), "is_qna_response": True
-            })
-        else:
-            request_type = 'QNA'
-
-    enrollment_query = db.collection('enrollments').where('user_id', '==', current_user.uid).where('course_id', '==', course['id']).limit(1).stream()
-    enrollment_list = list(enrollment_query)
-    enrollment_doc = enrollment_list[0] if enrollment_list else None
-    enrollment = _doc_to_dict(enrollment_doc) if enrollment_doc else None
-    
-    is_creator = (current_user.uid == course['user_id'])
-    if not enrollment and not is_creator and not current_user.is_admin: abort(403)
-
-    history_record_ref, current_step_index, current_chunk_index, chat_log = None, 0, 0, []
+@app.route('/chat/ask', methods=['POST'])
+@login_required
+@check_db_connection
+def ask_question():
+    """Classifies a free-form student question and answers it in the same request."""
+    data = request.json
+    question = data.get('user_input')
+    lesson, course, compiled, enrollment = _load_chat_lesson(data.get('lesson_id'))
+    intent_data = classify_question_intent(question, compiled.media_descriptions, lesson['id'])
+    if intent_data.get('intent') == 'MEDIA_REQUEST' and intent_data.get('alt_text') in compiled.media:
+        return _run_chat_turn(lesson, course, compiled, enrollment, question, 'MEDIA_REQUEST', bool(data.get('stream')),
+                              media_alt=intent_data.get('alt_text'))
+    return _run_chat_turn(lesson, course, compiled, enrollment, question, 'QNA', bool(data.get('stream')))
+
+def _run_chat_turn(lesson, course, compiled, enrollment, user_input, request_type, stream=False, media_alt=None):
+    """`media_alt` names the media a MEDIA_REQUEST asks for; without it `user_input` is the alt_text itself."""
+    lesson_id = lesson['id']
+    media_to_show = compiled.media.get(media_alt or user_input) if request_type == 'MEDIA_REQUEST' else None
+    if request_type == 'MEDIA_REQUEST' and not media_to_show:
+        request_type = 'QNA'
+
+    history_id, turn_count, current_step_index, current_chunk_index, chat_log = None, 0, 0, 0, []
+    enrollment_update = {}
     session_key = f'preview_chat_{lesson_id}'
 
     if enrollment:
-        history_query = db.collection('chat_histories').where('enrollment_id', '==', enrollment_doc.id).where('lesson_id', '==', lesson_id).limit(1).stream()
-        history_list = list(history_query)
-        if history_list:
-            history_record_ref = history_list[0].reference
-            history_record = _doc_to_dict(history_list[0])
+        # For enrolled students chat_log holds only this turn's new messages; earlier ones are already stored.
+        history_record = migrate_legacy_history(repo().find_chat_history(enrollment['id'], lesson_id))
+        if history_record:
+            history_id = history_record['id']
+            turn_count = history_record.get('turn_count', 0)
             current_step_index = history_record.get('current_step_index', 0)
             current_chunk_index = history_record.get('current_chunk_index', 0)
-            chat_log = json.loads(history_record.get('history_json', '[]'))
         else:
-            history_record_ref = db.collection('chat_histories').document()
+            history_id = chat_history_id_for(enrollment['id'], lesson_id)
     else: 
         if session_key in session and user_input is not None:
              state = session[session_key]
-             chat_log, current_step_index, current_chunk_index = state.get('chat_log', []), state.get('step_index', 0), state.get('chunk_index', 0)
+             current_step_index, current_chunk_index = state.get('step_index', 0), state.get('chunk_index', 0)
         else:
-             session[session_key] = {'step_index': 0, 'chunk_index': 0, 'chat_log': []}
+             session[session_key] = {'step_index': 0, 'chunk_index': 0}
+
+    wants_stream = stream and history_id is not None
+
+    def save_turn(log, step_index, chunk_index):
+        # One commit per turn: the new messages, the state document and any enrollment progress.
+        # That is at most len(log) + 2 writes, applied together or not at all.
+        def commit_turn(enrollment_id, target_history_id):
+            batch = repo().batch()
+            append_chat_turns(batch, target_history_id, turn_count, log)
+            state = {
+                'enrollment_id': enrollment_id, 'lesson_id': lesson_id,
+                'current_step_index': step_index, 'current_chunk_index': chunk_index, 'turn_count': turn_count + len(log)
+            }
+            # update() on a history that was read, so a moved one raises NotFound instead of being recreated.
+            if history_record: batch.update('chat_histories', target_history_id, state)
+            else: batch.set('chat_histories', target_history_id, state, merge=True)
+            if enrollment_update: batch.update('enrollments', enrollment_id, enrollment_update)
+            batch.commit()
+
+        if history_id:
+            try:
+                try:
+                    commit_turn(enrollment['id'], history_id)
+                except NotFound:
+                    # `flask migrate-document-ids` moved the enrollment or this history after the turn read it.
+                    moved_enrollment_id = enrollment_id_for(enrollment['user_id'], enrollment['course_id'])
+                    history_still_here = repo().ref('chat_histories', history_id).get().exists
+                    repo().record_transaction(reads=1)
+                    commit_turn(moved_enrollment_id, history_id if history_still_here else chat_history_id_for(moved_enrollment_id, lesson_id))
+            except Exception as e:
+                # Nothing was applied, so the student simply repeats this step on the next turn.
+                print(f"Error saving chat turn for history {history_id}: {e}")
+        else:
+            # Previews restart on every page load, so only the position is kept, never the log.
+            session[session_key] = {'step_index': step_index, 'chunk_index': chunk_index}
+            session.modified = True
 
     if user_input and request_type == 'LESSON_FLOW' and user_input != 'Continue':
         chat_log.append({"sender": "student", "type": "text", "content": user_input})
+
+    if media_to_show:
+        # Showing media again answers a question; the lesson position doesn't move.
+        tutor_text = f"Of course, here is '{media_to_show.get('alt_text')}' again."
+        chat_log.append({"sender": "student", "type": "text", "content": user_input})
+        chat_log.append({"sender": "tutor", "type": "text", "content": tutor_text})
+        chat_log.append({"sender": "tutor", "type": media_to_show.get('media_type', 'image'), "url": media_to_show.get('media_url'),
+                         "alt": media_to_show.get('alt_text'), "variants": media_to_show.get('media_variants', [])})
+        save_turn(chat_log, current_step_index, current_chunk_index)
+        return jsonify({
+            "tutor_text": tutor_text,
+            "media_url": media_to_show.get('media_url'), "media_type": media_to_show.get('media_type'),
+            "media_variants": media_to_show.get('media_variants', []),
+            "alt_text": media_to_show.get('alt_text'), "is_qna_response": True
+        })
     
     if request_type == 'QNA':
         chat_log.append({"sender": "student", "type": "text", "content": user_input})
         retriever = _get_or_create_rag_retriever(lesson['id'], lesson['raw_script'])
-        response_text = answer_question_with_rag(user_input, retriever)
+        rag_prompt, response_text = build_rag_prompt(user_input, retriever)
+        if rag_prompt and wants_stream:
+            return _stream_chat_reply(rag_prompt, {'is_qna_response': True}, chat_log,
+                                      lambda log, _text, _finished: save_turn(log, current_step_index, current_chunk_index))
+        if rag_prompt: response_text = get_tutor_response(rag_prompt)
         chat_log.append({"sender": "tutor", "type": "text", "content": response_text})
-        
-        update_payload = {'history_json': json.dumps(chat_log)}
-        if history_record_ref:
-            if history_record_ref.get().exists:
-                history_record_ref.update(update_payload)
-            else:
-                history_record_ref.set({**update_payload, 'enrollment_id': enrollment_doc.id, 'lesson_id': lesson_id, 'current_step_index': current_step_index, 'current_chunk_index': current_chunk_index})
-        else:
-            session[session_key]['chat_log'] = chat_log
-            session.modified = True
+        save_turn(chat_log, current_step_index, current_chunk_index)
         return jsonify({'is_qna_response': True, 'tutor_text': response_text})
 
     next_step_index, next_chunk_index = current_step_index, current_chunk_index
-    if current_step_index < len(lesson_steps):
-        step_type = lesson_steps[current_step_index].get('type')
-        if step_type == 'CONTENT':
-            content_chunks = [c for c in lesson_steps[current_step_index].get('text', '').split('\n\n') if c.strip()]
-            if (current_chunk_index + 1) < len(content_chunks):
-                next_chunk_index = current_chunk_index + 1
-            else:
-                next_step_index = current_step_index + 1
-                next_chunk_index = 0
+    if current_step_index < compiled.step_count:
+        if (current_chunk_index + 1) < compiled.chunk_count(current_step_index):
+            next_chunk_index = current_chunk_index + 1
         else:
             next_step_index = current_step_index + 1
             next_chunk_index = 0
-    
-    state_update_payload = {'current_step_index': next_step_index, 'current_chunk_index': next_chunk_index}
-    if history_record_ref:
-        if history_record_ref.get().exists:
-            history_record_ref.update(state_update_payload)
-        else:
-            history_record_ref.set({**state_update_payload, 'enrollment_id': enrollment_doc.id, 'lesson_id': lesson_id, 'history_json': '[]'})
-    else:
-        session[session_key]['step_index'] = next_step_index
-        session[session_key]['chunk_index'] = next_chunk_index
-        session.modified = True
 
-    response_data, model_response_text = {}, ""
-    if current_step_index >= len(lesson_steps):
+    response_data, model_response_text, tutor_prompt = {}, "", None
+    if current_step_index >= compiled.step_count:
         response_data['is_lesson_end'] = True
         model_response_text = "Congratulations! You've completed this chapter."
         if enrollment and enrollment.get('last_completed_chapter_number', 0) < lesson['chapter_number']:
-            enrollment_doc.reference.update({'last_completed_chapter_number': lesson['chapter_number']})
-            if lesson['chapter_number'] >= len(course['lessons']):
+            enrollment_update['last_completed_chapter_number'] = lesson['chapter_number']
+            next_chapter = next((e for e in live_toc(course) if e['chapter_number'] > lesson['chapter_number']), None)
+            if not next_chapter:
                 if not enrollment.get('completed_at'):
-                    enrollment_doc.reference.update({'completed_at': firestore.SERVER_TIMESTAMP})
+                    enrollment_update['completed_at'] = firestore.SERVER_TIMESTAMP
                 response_data['certificate_url'] = url_for('certificate_view', course_id=course['id'])
             else:
-                next_chapter_num = lesson['chapter_number'] + 1
-                response_data['next_chapter_url'] = url_for('student_chapter_view', course_id=course['id'], chapter_number=next_chapter_num)
+                response_data['next_chapter_url'] = url_for('student_chapter_view', course_id=course['id'], chapter_number=next_chapter['chapter_number'])
     else:
-        current_step_to_process = lesson_steps[current_step_index]
+        current_step_to_process = compiled.steps[current_step_index]
         step_type = current_step_to_process.get('type')
+        prompt, cache_key = compiled.tutor_prompt(current_step_index, current_chunk_index if step_type == 'CONTENT' else 0)
+        model_response_text = (get_cached_tutor_response(cache_key) if cache_key else None) or ""
+        if not model_response_text:
+            tutor_prompt = prompt
 
-        if step_type == 'CONTENT':
-            content_chunks = [c for c in current_step_to_process.get('text', '').split('\n\n') if c.strip()]
-            chunk_to_explain = content_chunks[current_chunk_index]
-            prompt = TUTOR_PROMPT_TEMPLATE['CONTENT'].format(chunk_to_explain)
-            model_response_text = get_tutor_response(prompt)
-        
-        elif step_type == 'MEDIA':
+        if step_type == 'MEDIA':
             media_type = current_step_to_process.get('media_type', 'image')
             alt_text = current_step_to_process.get('alt_text', '')
-            
-            prompt_template_key = f"MEDIA_{media_type.upper()}"
-            prompt_template = TUTOR_PROMPT_TEMPLATE.get(prompt_template_key, TUTOR_PROMPT_TEMPLATE['MEDIA_IMAGE'])
-            model_response_text = get_tutor_response(prompt_template.format(alt_text))
-            
             response_data.update({
                 'media_url': current_step_to_process.get('media_url'), 
-                'media_type': media_type, 'alt_text': alt_text
+                'media_type': media_type, 'alt_text': alt_text,
+                'media_variants': current_step_to_process.get('media_variants', [])
             })
-            chat_log.append({"sender": "tutor", "type": media_type, "url": current_step_to_process.get('media_url'), "alt": alt_text})
+            chat_log.append({"sender": "tutor", "type": media_type, "url": current_step_to_process.get('media_url'), "alt": alt_text,
+                             "variants": current_step_to_process.get('media_variants', [])})
 
         elif step_type in ['QUESTION_MCQ', 'QUESTION_SA']:
-            model_response_text = get_tutor_response(TUTOR_PROMPT_TEMPLATE['QUESTION'].format(current_step_to_process.get('question', '')))
             response_data['question'] = current_step_to_process
 
+    if tutor_prompt and wants_stream:
+        def finish_turn(log, tutor_text, finished):
+            # A reply cut short by a disconnect is kept in the student's log but never shared through the cache.
+            if finished: store_tutor_response(cache_key, tutor_text)
+            save_turn(log, next_step_index, next_chunk_index)
+        return _stream_chat_reply(tutor_prompt, response_data, chat_log, finish_turn)
+    if tutor_prompt:
+        model_response_text = get_tutor_response(tutor_prompt)
+        store_tutor_response(cache_key, model_response_text)
+
     if model_response_text:
         response_data['tutor_text'] = model_response_text
         chat_log.append({"sender": "tutor", "type": "text", "content": model_response_text})
     
-    log_payload = {'history_json': json.dumps(chat_log)}
-    if history_record_ref:
-        history_record_ref.update(log_payload)
-    else:
-        session[session_key]['chat_log'] = chat_log
-        session.modified = True
-        
+    save_turn(chat_log, next_step_index, next_chunk_index)
     return jsonify(response_data)
 
 @app.route('/chat/reset', methods=['POST'])
@@ -1016,23 +2549,37 @@ def chat():
 @check_db_connection
 def reset_conversation():
     lesson_id = request.json.get('lesson_id')
-    lesson_doc = db.collection('lessons').document(lesson_id).get()
-    if not lesson_doc.exists: abort(404)
-    lesson = _doc_to_dict(lesson_doc)
-
-    enrollment_query = db.collection('enrollments').where('user_id', '==', current_user.uid).where('course_id', '==', lesson['course_id']).limit(1).stream()
-    enrollment_list = list(enrollment_query)
-    if enrollment_list:
-        enrollment_doc = enrollment_list[0]
-        history_query = db.collection('chat_histories').where('enrollment_id', '==', enrollment_doc.id).where('lesson_id', '==', lesson_id).limit(1).stream()
-        history_list = list(history_query)
-        if history_list:
-            history_list[0].reference.update({'current_step_index': 0, 'current_chunk_index': 0, 'history_json': '[]'})
+    lesson = repo().get('lessons', lesson_id)
+    if not lesson: abort(404)
+
+    enrollment = repo().find_enrollment(current_user.uid, lesson['course_id'])
+    if enrollment:
+        history_record = repo().find_chat_history(enrollment['id'], lesson_id)
+        if history_record:
+            # Hide the old turns by moving first_seq past them, then delete them off the request path.
+            turn_count = history_record.get('turn_count', 0)
+            repo().update('chat_histories', history_record['id'], {
+                'current_step_index': 0, 'current_chunk_index': 0, 'first_seq': turn_count, 'turn_count': turn_count,
+                'history_json': firestore.DELETE_FIELD
+            })
+            BACKGROUND_EXECUTOR.submit(purge_chat_turns, history_record['id'], turn_count)
     else: 
         session_key = f'preview_chat_{lesson_id}'
         if session_key in session: del session[session_key]
     return jsonify({'success': True})
 
+@app.route('/chat/history')
+@login_required
+@check_db_connection
+def chat_history():
+    """Returns an older page of turns for the "load earlier messages" control."""
+    lesson = repo().get('lessons', request.args.get('lesson_id'))
+    if not lesson: abort(404)
+    enrollment = repo().find_enrollment(current_user.uid, lesson['course_id'])
+    history_record = repo().find_chat_history(enrollment['id'], lesson['id']) if enrollment else None
+    if not history_record: return jsonify({'turns': [], 'before': 0, 'has_more': False})
+    return jsonify(chat_history_page(history_record, request.args.get('before', type=int)))
+
 @app.route('/chat/delete_last_turn', methods=['POST'])
 @login_required
 @check_db_connection
@@ -1041,5 +2588,196 @@ def delete_last_turn():
     flash("This feature is complex and not yet implemented.", "info")
     return jsonify({'success': False, 'message': 'Feature under development.'})
 
+# --- Maintenance Commands ---
+def _migrate_enrollment(snapshot):
+    target_id = enrollment_id_for(snapshot.get('user_id'), snapshot.get('course_id'))
+    if snapshot.id == target_id: return 0
+    source_ref, target_ref = snapshot.reference, db.collection('enrollments').document(target_id)
+
+    # The app may be live: re-read the source inside the transaction so progress written since the
+    # page was listed is carried over, and a concurrent write makes the move retry instead of being lost.
+    @firestore.transactional
+    def move_enrollment(transaction):
+        source = source_ref.get(transaction=transaction)
+        if not source.exists: return 0
+        data = source.to_dict()
+        existing = target_ref.get(transaction=transaction)
+        histories = list(db.collection('chat_histories').where('enrollment_id', '==', snapshot.id).stream(transaction=transaction))
+        if existing.exists:
+            # A duplicate enrollment: keep whichever progress is further along.
+            current = existing.to_dict()
+            data['last_completed_chapter_number'] = max(current.get('last_completed_chapter_number', 0), data.get('last_completed_chapter_number', 0))
+            data['completed_at'] = current.get('completed_at') or data.get('completed_at')
+        transaction.set(target_ref, data)
+        for history in histories:
+            transaction.update(history.reference, {'enrollment_id': target_id})
+        transaction.delete(source_ref)
+        return 1
+
+    return move_enrollment(db.transaction())
+
+def _migrate_chat_history(snapshot):
+    target_id = chat_history_id_for(snapshot.get('enrollment_id'), snapshot.get('lesson_id'))
+    if snapshot.id == target_id: return 0
+    source_ref, target_ref = snapshot.reference, db.collection('chat_histories').document(target_id)
+    if target_ref.get().exists:
+        click.echo(f"Skipping chat history {snapshot.id}: {target_id} already exists.")
+        return 0
+    # Turns are append-only, so the bulk of them is copied up front, outside the transaction.
+    turns = list(source_ref.collection('turns').stream())
+    for start in range(0, len(turns), 400):
+        batch = db.batch()
+        for turn in turns[start:start + 400]:
+            batch.set(target_ref.collection('turns').document(turn.id), turn.to_dict())
+        batch.commit()
+    copied_below = max((turn.get('seq') for turn in turns), default=-1) + 1
+
+    # The state document is re-read and moved in a transaction, together with any turn committed since
+    # the copy above; a concurrent turn makes the move retry instead of being overwritten by a stale copy.
+    # Readers see either the old id or the new one, never neither.
+    @firestore.transactional
+    def move_history(transaction):
+        source = source_ref.get(transaction=transaction)
+        if not source.exists: return None
+        late_turns = list(source_ref.collection('turns').where('seq', '>=', copied_below).stream(transaction=transaction))
+        for turn in late_turns:
+            transaction.set(target_ref.collection('turns').document(turn.id), turn.to_dict())
+        transaction.set(target_ref, source.to_dict())
+        transaction.delete(source_ref)
+        return late_turns
+
+    late_turns = move_history(db.transaction())
+    if late_turns is None:
+        # Deleted while we copied: drop the copies rather than leave turns without a history.
+        for start in range(0, len(turns), 400):
+            batch = db.batch()
+            for turn in turns[start:start + 400]:
+                batch.delete(target_ref.collection('turns').document(turn.id))
+            batch.commit()
+        return 0
+    turns += late_turns
+    for start in range(0, len(turns), 400):
+        batch = db.batch()
+        for turn in turns[start:start + 400]:
+            batch.delete(turn.reference)
+        batch.commit()
+    return 1
+
+@app.cli.command('migrate-document-ids')
+@click.option('--batch-size', default=200, show_default=True, help='Documents read per page.')
+def migrate_document_ids(batch_size):
+    """Moves enrollments and chat histories to deterministic ids. Safe to interrupt and rerun."""
+    if not db: raise click.ClickException("Firestore is not configured.")
+    state_ref = db.collection('migrations').document('deterministic_ids')
+    state = _doc_to_dict(state_ref.get()) or {}
+    for collection, migrate in (('enrollments', _migrate_enrollment), ('chat_histories', _migrate_chat_history)):
+        if state.get(f'{collection}_done'):
+            click.echo(f"{collection}: already migrated")
+            continue
+        cursor, moved = state.get(f'{collection}_cursor'), 0
+        while True:
+            query = db.collection(collection).order_by('__name__').limit(batch_size)
+            if cursor: query = query.start_after({'__name__': cursor})
+            page = list(query.stream())
+            if not page: break
+            moved += sum(migrate(snapshot) for snapshot in page)
+            cursor = page[-1].id
+            state_ref.set({f'{collection}_cursor': cursor}, merge=True)
+        state_ref.set({f'{collection}_done': True}, merge=True)
+        click.echo(f"{collection}: moved {moved} documents")
+
+@app.cli.command('ingest-worker')
+@click.option('--once', is_flag=True, help='Exit when the queue is empty instead of waiting for new jobs.')
+def ingest_worker(once):
+    """Runs chapter ingestion jobs from the local queue in this process."""
+    if INGEST_QUEUE is None: raise click.ClickException("INGEST_BACKEND is not 'sqlite'; chapters are ingested inline.")
+    if not db: raise click.ClickException("Firestore is not configured.")
+    ingest_worker_loop(stop_when_idle=once)
+
+LESSON_PARSER_CORPUS = os.path.join(app.root_path, 'lesson_parser_corpus.json')
+
+def _conformance_view(steps):
+    """Steps reduced to what both parsers must agree on: adjacent CONTENT is merged and whitespace collapsed."""
+    view = []
+    for step in steps:
+        step = {k: v for k, v in step.items() if k in ('type', 'text', 'media_type', 'alt_text', 'question', 'options', 'answer', 'keywords')}
+        if step.get('type') == 'CONTENT':
+            text = ' '.join(step.get('text', '').split())
+            if view and view[-1]['type'] == 'CONTENT':
+                view[-1]['text'] += ' ' + text
+                continue
+            step['text'] = text
+        view.append(step)
+    return view
+
+@app.cli.command('check-lesson-parser')
+@click.option('--llm', is_flag=True, help='Also parse each case with the LLM and compare.')
+def check_lesson_parser(llm):
+    """Runs the lesson parser conformance corpus against the local parser and, optionally, the LLM."""
+    with open(LESSON_PARSER_CORPUS) as f:
+        corpus = json.load(f)
+    failures = 0
+    for case in corpus:
+        items = scan_lesson_script(case['script'])
+        steps = [item if kind == 'step' else {'type': 'CONTENT', 'text': item} for kind, item in items]
+        blocks = sum(1 for kind, _ in items if kind == 'block')
+        if steps != case['steps'] or blocks != case.get('llm_blocks', 0):
+            failures += 1
+            click.echo(f"local FAIL {case['name']}: {json.dumps(steps)}")
+        if llm and not case.get('llm_blocks'):
+            parsed = parse_lesson_script_with_llm(case['script'])
+            if not parsed or _conformance_view(parsed['steps']) != _conformance_view(case['steps']):
+                failures += 1
+                click.echo(f"llm   FAIL {case['name']}: {json.dumps(parsed)}")
+    click.echo(f"{len(corpus)} cases, {failures} failures")
+    if failures: raise SystemExit(1)
+
+def _save_backfilled_lesson(lesson_ref, read_parsed_json, parsed):
+    """Writes the steps with variants only if the lesson wasn't re-ingested since it was read; a later run picks it up."""
+    @firestore.transactional
+    def write_variants(transaction):
+        current = lesson_ref.get(transaction=transaction).to_dict() or {}
+        if current.get('parsed_json') != read_parsed_json: return False
+        transaction.update(lesson_ref, {'parsed_json': json.dumps(parsed), 'version': current.get('version', 0) + 1})
+        return True
+    return write_variants(db.transaction())
+
+@app.cli.command('backfill-image-variants')
+@click.option('--batch-size', default=100, show_default=True, help='Documents read per page.')
+def backfill_image_variants(batch_size):
+    """Builds WebP variants for course thumbnails and lesson images that have none, including legacy static/uploads files."""
+    if not db: raise click.ClickException("Firestore is not configured.")
+    updated = {'courses': 0, 'lessons': 0}
+    for collection in updated:
+        cursor = None
+        while True:
+            query = db.collection(collection).order_by('__name__').limit(batch_size)
+            if cursor: query = query.start_after({'__name__': cursor})
+            page = list(query.stream())
+            if not page: break
+            cursor = page[-1].id
+            for snapshot in page:
+                data = snapshot.to_dict()
+                if collection == 'courses':
+                    url = data.get('thumbnail_url')
+                    if not url or data.get('thumbnail_variants'): continue
+                    variants = image_variants_for([url]).get(url)
+                    if variants:
+                        snapshot.reference.update({'thumbnail_variants': variants})
+                        updated['courses'] += 1
+                    continue
+                parsed = json.loads(data.get('parsed_json') or '{}')
+                pending = [s for s in parsed.get('steps', []) if s.get('type') == 'MEDIA' and s.get('media_type') == 'image' and s.get('media_url') and not s.get('media_variants')]
+                if not pending: continue
+                variants = image_variants_for([s['media_url'] for s in pending])
+                for step in pending:
+                    if variants.get(step['media_url']): step['media_variants'] = variants[step['media_url']]
+                if any(step.get('media_variants') for step in pending):
+                    # Tutor replies are keyed by content, so the new version keeps them; it only makes
+                    # running servers recompile the lesson and pick up the variants.
+                    if _save_backfilled_lesson(snapshot.reference, data.get('parsed_json'), parsed): updated['lessons'] += 1
+    if updated['courses']: refresh_catalog_snapshot()
+    click.echo(f"courses: {updated['courses']} thumbnails, lessons: {updated['lessons']} updated")
+
 if __name__ == '__main__':
     app.run(debug=True)
@@ -74,11 +74,50 @@ document.addEventListener('DOMContentLoaded', () => {
 
             scriptInput.value = scriptText.trim();
 
+            // Upload media straight to storage first; the form then carries only the object names.
+            const uploadedMediaInput = document.getElementById('uploaded-media-input');
+            if (fileStore.files.length && lessonForm.dataset.uploadUrlsEndpoint && uploadedMediaInput) {
+                event.preventDefault();
+                const submitBtn = lessonForm.querySelector('button[type="submit"]');
+                if (submitBtn) submitBtn.disabled = true;
+                uploadMediaDirectly(lessonForm.dataset.uploadUrlsEndpoint)
+                    .then(objectNames => {
+                        uploadedMediaInput.value = JSON.stringify(objectNames);
+                        mediaUploadInput.value = '';
+                    })
+                    .catch(error => {
+                        // Fall back to sending the files with the form itself.
+                        console.error('Direct upload failed:', error);
+                        uploadedMediaInput.value = '';
+                        mediaUploadInput.files = fileStore.files;
+                    })
+                    .finally(() => lessonForm.submit());
+                return;
+            }
+
             // Attach the collected files to the hidden file input for submission
             mediaUploadInput.files = fileStore.files;
         });
     }
 
+    async function uploadMediaDirectly(endpoint) {
+        const files = Array.from(fileStore.files);
+        const csrfToken = lessonForm.querySelector('input[name="csrf_token"]').value;
+        const response = await fetch(endpoint, {
+            method: 'POST',
+            headers: { 'Content-Type': 'application/json', 'X-CSRF-TOKEN': csrfToken },
+            body: JSON.stringify({ files: files.map(f => ({ filename: f.name, content_type: f.type, size: f.size })) })
+        });
+        if (!response.ok) throw new Error(`Could not get upload URLs (${response.status})`);
+        const { uploads } = await response.json();
+        await Promise.all(uploads.map((upload, i) => fetch(upload.upload_url, {
+            method: 'PUT', headers: upload.headers, body: files[i]
+        }).then(res => {
+            if (!res.ok) throw new Error(`Upload of ${files[i].name} failed (${res.status})`);
+        })));
+        return uploads.map(upload => upload.object_name);
+    }
+
 
     // --- Helper Functions to insert content into the editor ---
 
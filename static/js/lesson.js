@@ -17,24 +17,9 @@ document.addEventListener('DOMContentLoaded', () => {
 
         addMessage(question, 'student');
         qnaInput.value = '';
-        isWaitingForResponse = true;
-
-        // 1. Call the new intent classifier route first
-        const intentResponse = await fetch('/chat/intent', {
-            method: 'POST',
-            headers: { 'Content-Type': 'application/json' ,'X-CSRF-TOKEN': CSRF_TOKEN},
-            body: JSON.stringify({ user_input: question, lesson_id: LESSON_ID })
-        });
-        const intentData = await intentResponse.json();
 
-        isWaitingForResponse = false;
-
-        // 2. Call postToChat with the classified intent
-        if (intentData.intent === 'MEDIA_REQUEST') {
-            postToChat(intentData.alt_text, 'MEDIA_REQUEST');
-        } else {
-            postToChat(intentData.query, 'QNA');
-        }
+        // The server classifies the question (media request or Q&A) and answers it in one round trip.
+        postToChat(question, 'QNA', '/chat/ask');
     }
 
     sendQnaBtn.addEventListener('click', sendQuestion);
@@ -102,20 +87,39 @@ document.addEventListener('DOMContentLoaded', () => {
         messageDiv.innerHTML = marked.parse(text);
         chatBox.appendChild(messageDiv);
         chatBox.scrollTop = chatBox.scrollHeight;
-        
+        typesetMessage(messageDiv);
+        return messageDiv;
+    }
+
+    function updateMessage(messageDiv, text) {
+        messageDiv.innerHTML = marked.parse(text);
+        chatBox.scrollTop = chatBox.scrollHeight;
+    }
+
+    function typesetMessage(messageDiv) {
         // FIX: Use the correct MathJax v3 command
-        if (window.MathJax) {
+        if (window.MathJax && window.MathJax.typeset) {
             window.MathJax.typeset([messageDiv]);
         }
     }
 
-    function addImageMessage(url, alt) {
+    function addImageMessage(url, alt, variants) {
         const messageDiv = document.createElement('div');
         messageDiv.className = 'message tutor-message media-message';
+        const picture = document.createElement('picture');
+        if (variants && variants.length) {
+            // WebP widths are picked by the browser; the original stays as the fallback src.
+            const source = document.createElement('source');
+            source.type = 'image/webp';
+            source.srcset = variants.map(v => `${v.url} ${v.width}w`).join(', ');
+            source.sizes = '300px';
+            picture.appendChild(source);
+        }
         const img = document.createElement('img');
         img.src = url;
         img.alt = alt;
-        messageDiv.appendChild(img);
+        picture.appendChild(img);
+        messageDiv.appendChild(picture);
         chatBox.appendChild(messageDiv);
         chatBox.scrollTop = chatBox.scrollHeight;
     }
@@ -192,7 +196,7 @@ document.addEventListener('DOMContentLoaded', () => {
     }
 
     // --- Core Chat Function ---
-    async function postToChat(userInput = null, requestType = 'LESSON_FLOW') {
+    async function postToChat(userInput = null, requestType = 'LESSON_FLOW', endpoint = '/chat') {
         isWaitingForResponse = true;
         systemMessage.innerText = 'Guidee is thinking...';
         systemMessage.style.display = 'block';
@@ -200,26 +204,79 @@ document.addEventListener('DOMContentLoaded', () => {
         sendQnaBtn.disabled = true;
         inputArea.innerHTML = ''; 
 
-        const response = await fetch('/chat', {
+        const response = await fetch(endpoint, {
             method: 'POST',
             headers: { 'Content-Type': 'application/json' ,'X-CSRF-TOKEN': CSRF_TOKEN},
-            body: JSON.stringify({ lesson_id: LESSON_ID, user_input: userInput, request_type: requestType })
+            body: JSON.stringify({ lesson_id: LESSON_ID, user_input: userInput, request_type: requestType, stream: true })
         });
-        const data = await response.json();
+
+        let data;
+        let streamedMessage = null;
+        let streamedText = '';
+        if ((response.headers.get('Content-Type') || '').includes('application/x-ndjson')) {
+            // Streamed reply: render text as it arrives, the last line carries the rest of the response.
+            data = await readChatStream(response, (text) => {
+                streamedText = text;
+                if (!streamedMessage) {
+                    systemMessage.style.display = 'none';
+                    streamedMessage = addMessage(text, 'tutor');
+                } else {
+                    updateMessage(streamedMessage, text);
+                }
+            });
+        } else {
+            data = await response.json();
+        }
 
         isWaitingForResponse = false;
         systemMessage.style.display = 'none';
         qnaInput.disabled = false;
         sendQnaBtn.disabled = false;
         
-        if (data.tutor_text) {
+        if (streamedMessage) {
+            // Without a final line (the stream was cut off) keep what already arrived.
+            updateMessage(streamedMessage, data.tutor_text || streamedText);
+            typesetMessage(streamedMessage);
+        } else if (data.tutor_text) {
              addMessage(data.tutor_text, 'tutor');
         }
+        renderChatResponse(data);
+    }
+
+    async function readChatStream(response, onText) {
+        const reader = response.body.getReader();
+        const decoder = new TextDecoder();
+        let buffer = '';
+        let text = '';
+        let finalData = {};
+        const handleLine = (line) => {
+            if (!line.trim()) return;
+            const message = JSON.parse(line);
+            if (message.done) {
+                finalData = message;
+            } else if (message.delta) {
+                text += message.delta;
+                onText(text);
+            }
+        };
+        while (true) {
+            const { value, done } = await reader.read();
+            if (done) break;
+            buffer += decoder.decode(value, { stream: true });
+            const lines = buffer.split('\n');
+            buffer = lines.pop();
+            lines.forEach(handleLine);
+        }
+        handleLine(buffer);
+        return finalData;
+    }
+
+    function renderChatResponse(data) {
         if (data.media_url) {
             if (data.media_type === 'audio') {
                 addAudioMessage(data.media_url, "Listen to the clip above:"); 
             } else {
-                addImageMessage(data.media_url, "View the image above");
+                addImageMessage(data.media_url, "View the image above", data.media_variants);
             }
         }
 
@@ -254,23 +311,48 @@ document.addEventListener('DOMContentLoaded', () => {
         }
     }
 
-    // --- Initialization Logic ---
-    function initializeLesson() {
-        if (initialHistoryRecord && initialHistoryRecord.history_json) {
+    // --- Chat History Logic ---
+    function addHistoryMessage(message) {
+        if (message.type === 'text') {
+            addMessage(message.content, message.sender);
+        } else if (message.type === 'image') {
+            addImageMessage(message.url, message.alt, message.variants);
+        } else if (message.type === 'audio') {
+            addAudioMessage(message.url, message.alt);
+        }
+    }
+
+    // Older turns are fetched a page at a time and inserted above what is already shown.
+    function showLoadEarlierButton(before) {
+        const loadEarlierBtn = document.createElement('button');
+        loadEarlierBtn.className = 'btn btn-secondary load-earlier-btn';
+        loadEarlierBtn.innerText = 'Load earlier messages';
+        loadEarlierBtn.onclick = async () => {
+            loadEarlierBtn.disabled = true;
             try {
-                const history = JSON.parse(initialHistoryRecord.history_json);
-                history.forEach(message => {
-                    if (message.type === 'text') {
-                        addMessage(message.content, message.sender);
-                    } else if (message.type === 'image') {
-                        addImageMessage(message.url, message.alt);
-                    } else if (message.type === 'audio') {
-                        addAudioMessage(message.url, message.alt);
-                    }
-                });
-            } catch (e) {
-                console.error("Could not parse chat history:", e);
+                const response = await fetch(`/chat/history?lesson_id=${encodeURIComponent(LESSON_ID)}&before=${before}`);
+                const page = await response.json();
+                const firstShown = loadEarlierBtn.nextSibling;
+                const previousHeight = chatBox.scrollHeight;
+                const alreadyShown = chatBox.children.length;
+                page.turns.forEach(addHistoryMessage);
+                Array.from(chatBox.children).slice(alreadyShown).forEach(node => chatBox.insertBefore(node, firstShown));
+                loadEarlierBtn.remove();
+                if (page.has_more) showLoadEarlierButton(page.before);
+                chatBox.scrollTop = chatBox.scrollHeight - previousHeight;
+            } catch (error) {
+                console.error("Could not load earlier messages:", error);
+                loadEarlierBtn.disabled = false;
             }
+        };
+        chatBox.insertBefore(loadEarlierBtn, chatBox.firstChild);
+    }
+
+    // --- Initialization Logic ---
+    function initializeLesson() {
+        if (initialHistoryRecord && initialHistoryRecord.turns) {
+            initialHistoryRecord.turns.forEach(addHistoryMessage);
+            if (initialHistoryRecord.has_more) showLoadEarlierButton(initialHistoryRecord.before);
         }
         
         // Always call postToChat. The backend will determine the correct next step,